@@ -1,20 +1,595 @@
 from vvmtools.analyze import DataRetriever
+from VVMcache import DiagnosticCache, VariableCache, cached_diagnostic
+from VVMcatalog import CaseCatalog
+from VVMkernels import Workspace, MaskReducer, Moments, center_shape, face_to_center, edge_to_center, forward_difference, sum_of_squares, horizontal_mean, joint_histogram
+from VVMprofile import Profiler, profiled, profiled_task
+from VVMstore import DiagnosticStore, provenance
+from contextlib import contextmanager
+from functools import partial
+import hashlib
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import pickle
+import time
 import numpy as np
+import xarray as xr
+
+# Diagnostics that calc_BL_diagnostics can return, in their default order
+BL_DIAGNOSTICS = ('th', 'TKE', 'Enstrophy', 'w_th')
+
+# Further diagnostics of calc_BL_diagnostics, derived from u, v, w with the finite-difference operators
+KINEMATIC_DIAGNOSTICS = ('Divergence', 'ShearProduction')
+
+# Velocity components of calc_scalar_fluxes: (staggered axis, leading points dropped 
+# along (z, y, x) at cell centers), all dropping the lowest level like w'θ'
+FLUX_COMPONENTS = {'w': (0, (1, 0, 0)), 'u': (2, (1, 0, 1)), 'v': (1, (1, 1, 0))}
+
+# Shared output arrays attached by the worker processes of func_time_shared, by segment name
+_SHARED_OUTPUTS = {}
+
+def _shared_step(func, name, shape, dtype, index, t, func_config=None):
+    """
+    Compute `func(t, func_config=func_config)` in a worker and write it in 
+    place into row `index` of the shared output array `name`.
+    """
+    if name not in _SHARED_OUTPUTS:
+        segment = shared_memory.SharedMemory(name=name)
+        _SHARED_OUTPUTS[name] = (segment, np.ndarray(shape, dtype=dtype, buffer=segment.buf))
+    result = np.asarray(func(t, func_config=func_config))
+    if result.shape != tuple(shape[1:]):
+        raise ValueError(f"Time step {t} returned shape {result.shape}, expected {tuple(shape[1:])}.")
+    _SHARED_OUTPUTS[name][1][index] = result
 
 class VVMTools_BL(DataRetriever):
     """
     A subclass of VVMTools to provide additional methods specific to 
     boundary layer calculations such as TKE, enstrophy, and boundary 
     layer height.
+
+    With `precision='float32'` the regridded fields and perturbation 
+    products of the calc_* methods are held in float32, while horizontal 
+    means are accumulated in float64. Each TKE or enstrophy value then 
+    passes through at most five float32 roundings, so the relative error 
+    of the profiles versus float64 is below 6 * 2**-24 (about 4e-7). For 
+    w'θ' the float32 rounding of the mean θ (about 300 K) adds an absolute 
+    error of at most 2**-24 * θ ≈ 2e-5 K to θ', so the w'θ' profile error 
+    is bounded by about 2e-5 K times the mean |w'| plus a relative 4e-7, 
+    far below the 1e-3 K m/s thresholds used for boundary layer detection.
+
+    With `profile=True` the read, compute and reduce times of every calc_* 
+    time step, the bytes read per variable, cache hits and the time spent 
+    in find_BL_boundary are recorded in `self.profiler`, including the 
+    work done in worker processes. `self.profiler.dump("profile.json")` 
+    writes the summary.
+
+    With `read_levels=n` horizontal means are reduced on read: get_var and 
+    get_var_parallel with `compute_mean=True`, and calc_w_th, read the 
+    file n levels at a time and reduce every block before reading the 
+    next, so a mean profile never holds a full 3D field and the peak 
+    memory per worker drops from O(nx·ny·nz) to O(nx·ny·n).
     """
-    def __init__(self,case_path):
+    def __init__(self, case_path, cache_dir=None, cache_max_bytes=2**30, var_cache_bytes=0, precision=None,
+                 profile=False, catalog_path=None, read_levels=None, debug_mode=False):
         """
         A subclass of VVMTools to provide additional methods specific to 
         boundary layer calculations such as TKE, enstrophy, and boundary 
         layer height.
+
+        :param case_path: Path to the case simulation data.
+        :param cache_dir: Optional directory for an on-disk cache of per-time-step 
+                          diagnostics, so reruns skip the computation.
+        :param cache_max_bytes: Size bound of the on-disk cache in bytes.
+        :param var_cache_bytes: Size bound in bytes of an opt-in in-memory cache of raw 
+                                variable reads used by get_var, e.g. 256 * 2**20. 0 (the 
+                                default) disables it. With the cache, NumPy results of 
+                                get_var are read-only, and every worker of a pool holds 
+                                its own cache of up to this size.
+        :param precision: Compute dtype of the diagnostics, e.g. 'float32'. By default 
+                          the dtype NumPy promotes the input variables to is used.
+        :param profile: Record timings, bytes read and cache hits in `self.profiler`.
+        :param catalog_path: JSON file of the variable catalog of the case (see CaseCatalog), built 
+                             on first use and reused while the output files are unchanged, so 
+                             reopening the case reads no NetCDF file. By default it is kept in 
+                             `cache_dir`, and only held in memory without one; False disables 
+                             reusing and saving it.
+        :param read_levels: Number of levels read at a time when reducing on read, None to 
+                            read whole fields.
+        :param debug_mode: Enable debug logging, see DataRetriever.
+        """
+        # Compute dtype of the diagnostics, None to follow the inputs
+        self.PRECISION = np.dtype(precision) if precision else None
+
+        # In-memory cache of raw reads, needed by get_var while the parent class initializes
+        self.var_cache = VariableCache(var_cache_bytes) if var_cache_bytes > 0 else None
+
+        # Opt-in instrumentation, also needed by get_var while the parent class initializes
+        self.profiler = Profiler(enabled=profile)
+
+        # Levels per block of the reduce-on-read paths, None to read whole fields
+        self.READ_LEVELS = read_levels
+
+        # A saved catalog lets the parent class fill VARTYPE, INIT and DIM without probe reads
+        if catalog_path is None:
+            catalog_path = self._default_catalog_path(case_path, cache_dir)
+        self.catalog = CaseCatalog.load(catalog_path, case_path) if catalog_path else None
+        catalog_loaded = self.catalog is not None
+
+        super().__init__(case_path, debug_mode=debug_mode)
+
+        if not catalog_loaded:
+            self.catalog = CaseCatalog.build(self)
+            if catalog_path:
+                self.catalog.save(catalog_path)
+
+        # Height levels (zc) in kilometers, read once on first use
+        self._zc_km = None
+
+        # Grid spacing of the finite-difference operators, derived once on first use
+        self._grid_spacing = None
+
+        # Output files of each time step, indexed on first use
+        self._file_index = None
+
+        # Reusable buffers for the regridding kernels
+        self._workspace = Workspace()
+
+        # Reducers of the region masks seen so far, keyed by a hash of the mask
+        self._mask_reducers = {}
+
+        # Opt-in on-disk cache of the calc_* results
+        self.diagnostic_cache = DiagnosticCache(cache_dir, cache_max_bytes) if cache_dir else None
+
+    @staticmethod
+    def _default_catalog_path(case_path, cache_dir):
+        """
+        Catalog file of a case in the cache directory, None without one, so 
+        the case directory is never written to.
+        """
+        if not cache_dir:
+            return None
+        case_key = hashlib.sha1(os.path.abspath(case_path).encode()).hexdigest()[:16]
+        return os.path.join(cache_dir, f'catalog-{case_key}.json')
+
+    # The initialization steps of DataRetriever, served from a loaded catalog
+
+    def _build_variable_type_dict(self):
+        if self.catalog is None:
+            return super()._build_variable_type_dict()
+        # The catalog records the final VARTYPE, including the TOPO variables
+        self.VARTYPE.update(self.catalog.vartype())
+
+    def _load_topo_variables(self):
+        if self.catalog is None:
+            return super()._load_topo_variables()
+
+    def _get_initial_profile(self):
+        if self.catalog is None:
+            return super()._get_initial_profile()
+        self.INIT.update(self.catalog.init)
+
+    def _build_dimension(self):
+        if self.catalog is None:
+            return super()._build_dimension()
+        self.DIM.update(xc=self.catalog.coord('xc'), yc=self.catalog.coord('yc'), 
+                        zc=self.INIT['ZC'], zz=self.INIT['ZZ'])
+
+    def get_var(self, 
+                var, 
+                time, 
+                domain_range=(None, None, None, None, None, None), # (k1, k2, j1, j2, i1, i2)
+                numpy=False, 
+                compute_mean=False, 
+                axis=None):
+        """
+        Get a variable's data at a specified time and domain range, see 
+        DataRetriever.get_var.
+
+        With `var_cache_bytes` set, NumPy requests go through an in-memory LRU 
+        cache of full-domain reads, so repeated reads of a variable at the same time step, including for 
+        different subdomains, are sliced from memory instead of decoding the 
+        file again. The returned arrays are read-only views into the cache.
+
+        With `read_levels` set, horizontal and domain means of 3D variables 
+        that are not cached are reduced on read, level block by level block.
+        """
+        cache = self.var_cache
+        if numpy and compute_mean and self.READ_LEVELS and (cache is None or (var, int(time)) not in cache):
+            mean = self._mean_on_read(var, time, domain_range, axis)
+            if mean is not None:
+                return mean
+
+        if not numpy or cache is None or self._get_variable_file_type(var) in ("TOPO", "Variable not found"):
+            with self.profiler.section('get_var.read'):
+                data = super().get_var(var, time, domain_range, numpy, compute_mean, axis)
+            if numpy and not compute_mean:
+                self.profiler.add_bytes(var, getattr(data, 'nbytes', 0))
+            return data
+
+        self._Range_tuple_check(domain_range)
+        key = (var, int(time))
+        data = cache.get(key)
+        if data is None:
+            self.profiler.count('var_cache.miss')
+            with self.profiler.section('get_var.read'):
+                data = self._read_full(var, time)
+                if data is None:
+                    return None
+            self.profiler.add_bytes(var, data.nbytes)
+            cache.put(key, data)
+        else:
+            self.profiler.count('var_cache.hit')
+
+        # Slice the (time, [z,] y, x) array the same way as DataRetriever.get_var
+        k1, k2, j1, j2, i1, i2 = domain_range
+        if data.ndim == 4:
+            data = data[0, k1:k2, j1:j2, i1:i2]
+        elif data.ndim == 3:
+            data = data[0, j1:j2, i1:i2]
+        elif any(r is not None for r in domain_range):
+            return super().get_var(var, time, domain_range, numpy, compute_mean, axis)
+        data = np.squeeze(data)
+
+        if compute_mean and axis is not None:
+            return np.mean(data, axis=axis)
+        elif compute_mean:
+            return np.mean(data)
+        return data
+
+    def _read_full(self, var, time):
+        """
+        Full-domain (time, [z,] y, x) array of a variable, opening the file 
+        the catalog names for it directly instead of searching the case directory.
+        """
+        path = self.catalog.file_path(var, time) if self.catalog is not None and var in self.catalog else None
+        if path is None or not os.path.exists(path):
+            variable_data = super().get_var(var, time)
+            return None if variable_data is None else variable_data.to_numpy()
+        with xr.open_dataset(path) as ds:
+            return ds[self.catalog.info(var)['source']].to_numpy()
+
+    def iter_levels(self, var, time, domain_range=(None, None, None, None, None, None), levels=None):
+        """
+        Read a 3D variable at one time step in blocks of levels, so only one 
+        block is held in memory at a time.
+
+        Example:
+            >>> for k, th in myTool.iter_levels("th", 0, levels=4):
+            >>>     th_mean[k:k + len(th)] = th.mean(axis=(1, 2))
+
+        :param var: Name of the variable.
+        :param time: Time step.
+        :param domain_range: Tuple (k1, k2, j1, j2, i1, i2) on the raw grid.
+        :param levels: Number of levels per block, by default `read_levels` or 1.
+        :return: Generator of (k, block), the first level index k on the raw grid 
+                 and the (levels, y, x) block starting there.
+        """
+        self._Range_tuple_check(domain_range)
+        path = self.catalog.file_path(var, time) if var in self.catalog else None
+        if path is None or len(self.catalog.info(var)['dims']) != 4:
+            raise ValueError(f"{var} is not a 3D variable written per time step.")
+        levels = levels or self.READ_LEVELS or 1
+        k1, k2, j1, j2, i1, i2 = domain_range
+        with xr.open_dataset(path) as ds:
+            variable = ds[self.catalog.info(var)['source']]
+            start, stop, _ = slice(k1, k2).indices(variable.shape[1])
+            for k in range(start, stop, levels):
+                with self.profiler.section('get_var.read'):
+                    block = variable[0, k:min(k + levels, stop), j1:j2, i1:i2].to_numpy()
+                self.profiler.add_bytes(var, block.nbytes)
+                yield k, block
+
+    def _mean_on_read(self, var, time, domain_range, axis):
+        """
+        Mean of get_var over the horizontal axes (axis (1, 2)) or the whole 
+        range (axis None), reduced block by block with iter_levels. None when 
+        the request is not such a mean of a 3D variable, e.g. for other axes 
+        or ranges that get_var squeezes to fewer dimensions.
+        """
+        if var not in self.catalog or self.catalog.file_path(var, time) is None:
+            return None
+        shape = self.catalog.shape(var)
+        if len(shape) != 4:
+            return None
+        extents = [len(range(*slice(start, stop).indices(n))) 
+                   for start, stop, n in zip(domain_range[::2], domain_range[1::2], shape[1:])]
+        if min(extents) < 2 or axis not in (None, (1, 2), [1, 2], (-2, -1)):
+            return None
+
+        if axis is not None:
+            return np.concatenate([np.mean(block, axis=(1, 2)) for _, block in self.iter_levels(var, time, domain_range)])
+        total, dtype = 0., None
+        for _, block in self.iter_levels(var, time, domain_range):
+            total += np.sum(block, dtype=np.float64)
+            dtype = block.dtype
+        mean = total / np.prod(extents)
+        return dtype.type(mean) if np.issubdtype(dtype, np.floating) else mean
+
+    def _eta_name(self):
+        """
+        Name of the eta output on the grid of xi: 'eta', or 'eta_2' when the 
+        first file type holding an eta has it on a different grid.
         """
-        super().__init__(case_path)
+        if 'eta_2' in self.catalog and self.catalog.shape('eta') != self.catalog.shape('xi'):
+            return 'eta_2'
+        return 'eta'
+
+    def _timestep_files(self, t):
+        """
+        Paths of all output files written for time step `t`.
+        """
+        if self._file_index is None or int(t) not in self._file_index:
+            self._index_files()
+        return self._file_index.get(int(t), [])
+
+    def _index_files(self):
+        """
+        Walk the case directory and index the output files by time step.
+        """
+        index = {}
+        for root, dirs, files in os.walk(self.CASEPATH):
+            for filename in files:
+                case_name, variable_type, time_info = self._extract_file_info(filename)
+                if time_info is not None:
+                    index.setdefault(int(time_info), []).append(os.path.join(root, filename))
+        self._file_index = index
+        return index
+
+    def _completed_steps(self, start, settle_time):
+        """
+        Consecutive time steps from `start` whose output is complete: every 
+        output file type of the first time step exists and none was modified 
+        within the last `settle_time` seconds, so it is not being written.
+        """
+        index = self._index_files()
+        if not index:
+            return []
+        n_types = len(index[min(index)])
+        now = time.time()
+        steps = []
+        t = start
+        while len(index.get(t, [])) >= n_types:
+            try:
+                if any(now - os.stat(path).st_mtime < settle_time for path in index[t]):
+                    break
+            except FileNotFoundError:
+                break
+            steps.append(t)
+            t += 1
+        return steps
     
+    @staticmethod
+    def _region_slices(domain_range, shape, offset=(0, 0, 0)):
+        """
+        Translate a `domain_range` on the raw grid into slices of a field that 
+        was regridded over the full domain.
+
+        Regridding drops the first `offset` points along (z, y, x), so reducing 
+        the returned slices covers exactly the cells obtained by regridding 
+        the subdomain itself.
+
+        :param domain_range: Tuple (k1, k2, j1, j2, i1, i2) on the raw grid.
+        :param shape: Shape (nz, ny, nx) of the raw full-domain field.
+        :param offset: Number of points dropped at the start of each axis by regridding.
+        :return: Tuple of slices into the regridded field.
+        """
+        slices = []
+        for start, stop, n, off in zip(domain_range[::2], domain_range[1::2], shape, offset):
+            lo, hi, _ = slice(start, stop).indices(n)
+            slices.append(slice(lo, max(hi - off, lo)))
+        return tuple(slices)
+
+    def _compute_dtype(self, *arrays):
+        """
+        Dtype of the intermediate fields computed from `arrays`.
+        """
+        return self.PRECISION or np.result_type(*arrays)
+
+    def _mean(self, field, skipna=True):
+        """
+        Horizontal mean of a field, accumulated in float64 when a compute precision is set.
+        """
+        return horizontal_mean(field, skipna=skipna, dtype=np.float64 if self.PRECISION else None)
+
+    def _TKE_field(self, u, v, w):
+        """
+        TKE at cell centers from staggered (u, v, w), dropping the first 
+        point along each axis. The result is a workspace buffer that the 
+        next call overwrites.
+        """
+        # Regrid velocities to calculate TKE at cell centers
+        shape = center_shape(u.shape, (1, 1, 1))
+        dtype = self._compute_dtype(u, v, w)
+        u_regrid = face_to_center(u, 2, out=self._workspace.get('u_regrid', shape, dtype))
+        v_regrid = face_to_center(v, 1, out=self._workspace.get('v_regrid', shape, dtype))
+        w_regrid = face_to_center(w, 0, out=self._workspace.get('w_regrid', shape, dtype))
+
+        # Calculate TKE = 0.5 * (u^2 + v^2 + w^2)
+        return sum_of_squares([u_regrid, v_regrid, w_regrid])
+
+    def _enstrophy_field(self, xi, eta, zeta):
+        """
+        Enstrophy at cell centers from (xi, eta, zeta), dropping the first 
+        point along each axis. The result is a workspace buffer that the 
+        next call overwrites.
+        """
+        # Regrid vorticity to calculate Enstrophy
+        shape = center_shape(xi.shape, (1, 1, 1))
+        dtype = self._compute_dtype(xi, eta, zeta)
+        xi_inter = edge_to_center(xi, (1, 2), out=self._workspace.get('xi_inter', shape, dtype))
+        eta_inter = edge_to_center(eta, (0, 2), out=self._workspace.get('eta_inter', shape, dtype))
+        zeta_inter = edge_to_center(zeta, (0, 1), out=self._workspace.get('zeta_inter', shape, dtype))
+        
+        # Calculate and return enstrophy 
+        return sum_of_squares([xi_inter, eta_inter, zeta_inter])
+
+    def _w_th_field(self, w, th):
+        """
+        w'θ' at cell centers from full-domain w and th, dropping the lowest 
+        level, with perturbations from the full-domain means. The result is 
+        a workspace buffer that the next call overwrites.
+        """
+        shape = center_shape(w.shape, (1, 0, 0))
+        dtype = self._compute_dtype(w, th)
+
+        # Regrid w to center points and calculate w' (perturbation of w)
+        w_prime = face_to_center(w, 0, out=self._workspace.get('w_prime', shape, dtype), drop_first=(1, 0, 0))
+        w_prime -= self._mean(w_prime, skipna=False)[:, np.newaxis, np.newaxis]
+
+        # Calculate θ' (theta perturbation)
+        th = th[1:]
+        th_prime = np.subtract(th, self._mean(th, skipna=False)[:, np.newaxis, np.newaxis], 
+                               out=self._workspace.get('th_prime', shape, dtype))
+
+        # Calculate the covariance w'θ'
+        return np.multiply(w_prime, th_prime, out=w_prime)
+
+    def grid_spacing(self):
+        """
+        Spacing of the Arakawa C grid in meters, derived once from the cell 
+        centers along x and y and the heights of the w levels (zc).
+
+        Cell k lies between the w levels k-1 and k, so it is zc[k] - zc[k-1] 
+        thick, and the cell centers around w level k are (zc[k+1] - zc[k-1]) / 2 
+        apart. The lowest cell, below the surface, repeats the first layer.
+
+        :return: Dictionary with "dx" and "dy" (scalars), "dz" (thickness of every cell, (z,)) 
+                 and "dzw" (distance between the cell centers around every w level, (z,)).
+        """
+        if self._grid_spacing is None:
+            zc = np.asarray(self.DIM['zc'], dtype=np.float64)
+            dz = np.diff(zc, prepend=2 * zc[0] - zc[1])
+            dzw = np.empty_like(dz)
+            dzw[:-1] = 0.5 * (dz[:-1] + dz[1:])
+            dzw[-1] = dz[-1]
+            self._grid_spacing = {'dx': float(self.DIM['xc'][1] - self.DIM['xc'][0]),
+                                  'dy': float(self.DIM['yc'][1] - self.DIM['yc'][0]),
+                                  'dz': dz, 'dzw': dzw}
+        return self._grid_spacing
+
+    def curl(self, u, v, w):
+        """
+        Vorticity of full-domain staggered velocities on the cell edges where 
+        VVM writes it: xi = ∂w/∂y - ∂v/∂z between the w levels and v points, 
+        eta = ∂u/∂z - ∂w/∂x between the w levels and u points, and 
+        zeta = ∂v/∂x - ∂u/∂y between the u and v points.
+
+        The domain is doubly periodic, and the vertical shear vanishes at the 
+        free-slip lid above the last w level. The results are workspace 
+        buffers that the next call overwrites.
+
+        :param u: Zonal velocity (z, y, x) on the full domain.
+        :param v: Meridional velocity (z, y, x) on the full domain.
+        :param w: Vertical velocity (z, y, x) on the full domain.
+        :return: Tuple (xi, eta, zeta) of the shape of the velocities.
+        """
+        grid = self.grid_spacing()
+        dtype = self._compute_dtype(u, v, w)
+        buffer = lambda name: self._workspace.get(name, w.shape, dtype)
+        xi = forward_difference(w, 1, grid['dy'], out=buffer('xi'), periodic=True)
+        xi -= forward_difference(v, 0, grid['dzw'], out=buffer('curl_term'))
+        eta = forward_difference(u, 0, grid['dzw'], out=buffer('eta'))
+        eta -= forward_difference(w, 2, grid['dx'], out=buffer('curl_term'), periodic=True)
+        zeta = forward_difference(v, 2, grid['dx'], out=buffer('zeta'), periodic=True)
+        zeta -= forward_difference(u, 1, grid['dy'], out=buffer('curl_term'), periodic=True)
+        return xi, eta, zeta
+
+    def divergence(self, u, v, w):
+        """
+        Velocity divergence ∂u/∂x + ∂v/∂y + ∂w/∂z at cell centers from 
+        full-domain staggered velocities, dropping the first point along each 
+        axis like TKE. The result is a workspace buffer that the next call 
+        overwrites.
+        """
+        grid = self.grid_spacing()
+        shape = center_shape(w.shape, (1, 1, 1))
+        dtype = self._compute_dtype(u, v, w)
+        div = np.subtract(u[1:, 1:, 1:], u[1:, 1:, :-1], out=self._workspace.get('divergence', shape, dtype))
+        div /= grid['dx']
+        term = np.subtract(v[1:, 1:, 1:], v[1:, :-1, 1:], out=self._workspace.get('divergence_term', shape, dtype))
+        term /= grid['dy']
+        div += term
+        term = np.subtract(w[1:, 1:, 1:], w[:-1, 1:, 1:], out=term)
+        term /= grid['dz'][1:, np.newaxis, np.newaxis]
+        div += term
+        return div
+
+    def horizontal_gradient(self, phi):
+        """
+        Horizontal gradient of a full-domain cell-center field (e.g. θ, tracers) 
+        on the doubly periodic domain, ∂φ/∂x at the u points and ∂φ/∂y at the 
+        v points. The results are workspace buffers that the next call overwrites.
+
+        :return: Tuple (∂φ/∂x, ∂φ/∂y) of the shape of `phi`.
+        """
+        grid = self.grid_spacing()
+        dtype = self._compute_dtype(phi)
+        ddx = forward_difference(phi, 2, grid['dx'], out=self._workspace.get('ddx', phi.shape, dtype), periodic=True)
+        ddy = forward_difference(phi, 1, grid['dy'], out=self._workspace.get('ddy', phi.shape, dtype), periodic=True)
+        return ddx, ddy
+
+    def ddz(self, phi):
+        """
+        Vertical derivative of a cell-center field (e.g. θ, u, v) at the w 
+        levels, zero at the free-slip lid above the last one. The result is 
+        a workspace buffer that the next call overwrites.
+        """
+        return forward_difference(phi, 0, self.grid_spacing()['dzw'], 
+                                  out=self._workspace.get('ddz', phi.shape, self._compute_dtype(phi)))
+
+    def _derive_vorticity(self, func_config):
+        """
+        Whether enstrophy is computed from the curl of (u, v, w) instead of 
+        the vorticity output: with `{"vorticity": "derived"}` in func_config, 
+        or by default when the case has no vorticity output.
+        """
+        source = func_config.get('vorticity', 'output' if 'xi' in self.VARTYPE else 'derived')
+        if source not in ('output', 'derived'):
+            raise ValueError(f"Unknown vorticity source {source!r}, choose from ('output', 'derived').")
+        return source == 'derived'
+
+    def _derived_enstrophy_field(self, u, v, w):
+        """
+        Enstrophy at cell centers from the curl of full-domain (u, v, w), 
+        dropping the first point along each axis. The result is a workspace 
+        buffer that the next call overwrites.
+        """
+        xi, eta, zeta = self.curl(u, v, w)
+        shape = center_shape(w.shape, (1, 1, 1))
+        # Average every component over the two axes along which its edges are staggered
+        xi_inter = edge_to_center(xi, (0, 1), out=self._workspace.get('xi_inter', shape, xi.dtype))
+        eta_inter = edge_to_center(eta, (0, 2), out=self._workspace.get('eta_inter', shape, xi.dtype))
+        zeta_inter = edge_to_center(zeta, (1, 2), out=self._workspace.get('zeta_inter', shape, xi.dtype))
+        return sum_of_squares([xi_inter, eta_inter, zeta_inter])
+
+    def _shear_production_field(self, u, v, w):
+        """
+        Shear production of TKE, -(u'w' ∂U/∂z + v'w' ∂V/∂z), at cell centers 
+        from full-domain (u, v, w), dropping the first point along each axis, 
+        with perturbations from the full-domain mean profiles (U, V). The 
+        result is a workspace buffer that the next call overwrites.
+        """
+        shape = center_shape(w.shape, (1, 1, 1))
+        dtype = self._compute_dtype(u, v, w)
+        zc = np.asarray(self.DIM['zc'], dtype=np.float64)
+        z_center = 0.5 * (zc[1:] + zc[:-1])
+
+        w_prime = face_to_center(w, 0, out=self._workspace.get('w_prime_sp', shape, dtype))
+        w_prime -= self._mean(w_prime, skipna=False)[:, np.newaxis, np.newaxis]
+        production = self._workspace.get('shear_production', shape, dtype)
+        for i, (velocity, axis) in enumerate(((u, 2), (v, 1))):
+            prime = face_to_center(velocity, axis, out=self._workspace.get('velocity_prime_sp', shape, dtype))
+            mean = self._mean(prime, skipna=False)
+            prime -= mean[:, np.newaxis, np.newaxis]
+            prime *= w_prime
+            prime *= -np.gradient(mean, z_center)[:, np.newaxis, np.newaxis]
+            if i == 0:
+                production[...] = prime
+            else:
+                production += prime
+        return production
+
+    @cached_diagnostic
     def calc_TKE(self, time_steps, func_config):
         """
         Calculate the Turbulent Kinetic Energy (TKE) using the velocity 
@@ -25,47 +600,50 @@ class VVMTools_BL(DataRetriever):
         :return: Mean TKE over the domain at each time step.
         """
         # Get velocity components (u, v, w) for the specified time steps
-        u = np.squeeze(self.get_var('u', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        v = np.squeeze(self.get_var('v', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        w = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=func_config['domain_range'])) 
-        
-        # Regrid velocities to calculate TKE at cell centers
-        u_regrid = (u[:, :, 1:] + u[:, :, :-1])[1:, 1:, :] / 2
-        v_regrid = (v[:, 1:, :] + v[:, :-1, :])[1:, :, 1:] / 2
-        w_regrid = (w[1:, :, :] + w[:-1, :, :])[:, 1:, 1:] / 2
-
-        # Calculate TKE = 0.5 * (u^2 + v^2 + w^2)
-        TKE = u_regrid**2 + v_regrid**2 + w_regrid**2
-        return np.nanmean(TKE, axis=(1,2))
+        with self.profiler.section('calc_TKE.read'):
+            u = np.squeeze(self.get_var('u', time_steps, numpy=True, domain_range=func_config['domain_range']))
+            v = np.squeeze(self.get_var('v', time_steps, numpy=True, domain_range=func_config['domain_range']))
+            w = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=func_config['domain_range'])) 
+        with self.profiler.section('calc_TKE.compute'):
+            TKE = self._TKE_field(u, v, w)
+        with self.profiler.section('calc_TKE.reduce'):
+            return self._mean(TKE)
     
+    @cached_diagnostic
     def calc_Enstrophy(self, time_steps, func_config):
         """
         Calculate enstrophy using the vorticity components (xi, eta, zeta).
+
+        Without vorticity output, or with `{"vorticity": "derived"}` in 
+        func_config, the vorticity is the curl of (u, v, w) instead.
         
         :param time_steps: List of time steps to compute enstrophy.
         :param func_config: Configuration dictionary with domain range.
         :return: Mean enstrophy over the domain at each time step.
         """
-        # Get vorticity components (xi, eta, zeta)
-        xi = np.squeeze(self.get_var('xi', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        eta = np.squeeze(self.get_var('eta', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        
-        # Check if eta needs to be loaded from a different variable (eta_2)
-        if xi.shape ==  eta.shape:
-            pass
-        else:
-            eta = np.squeeze(self.get_var('eta_2', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        zeta = np.squeeze(self.get_var('zeta', time_steps, numpy=True, domain_range=func_config['domain_range']))
+        if self._derive_vorticity(func_config):
+            full_range = (None,None,None,None,None,None)
+            with self.profiler.section('calc_Enstrophy.read'):
+                u = np.squeeze(self.get_var('u', time_steps, numpy=True, domain_range=full_range))
+                v = np.squeeze(self.get_var('v', time_steps, numpy=True, domain_range=full_range))
+                w = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=full_range))
+            with self.profiler.section('calc_Enstrophy.compute'):
+                enstrophy = self._derived_enstrophy_field(u, v, w)
+            with self.profiler.section('calc_Enstrophy.reduce'):
+                return self._mean(enstrophy[self._region_slices(func_config['domain_range'], w.shape, (1, 1, 1))])
 
-        # Regrid vorticity to calculate Enstrophy
-        xi_inter = (xi[:, 1:, 1:] + xi[:, :-1, 1:] + xi[:, 1:, :-1] + xi[:, :-1, :-1])[1:] / 4
-        eta_inter = (eta[1:, :, 1:] + eta[:-1, :, 1:] + eta[1:, :, :-1] + eta[:-1, :, :-1])[:, 1:] / 4
-        zeta_inter = (zeta[1:, 1:] + zeta[:-1, 1:] + zeta[1:, :-1] + zeta[:-1, :-1])[:, :, 1:] / 4
-        
-        # Calculate and return mean enstrophy 
-        enstrophy = xi_inter ** 2 + eta_inter ** 2 + zeta_inter ** 2
-        return np.nanmean((enstrophy), axis=(1,2))
+        # Get vorticity components (xi, eta, zeta)
+        with self.profiler.section('calc_Enstrophy.read'):
+            xi = np.squeeze(self.get_var('xi', time_steps, numpy=True, domain_range=func_config['domain_range']))
+            # The catalog tells whether eta is stored as eta_2, on the grid of xi
+            eta = np.squeeze(self.get_var(self._eta_name(), time_steps, numpy=True, domain_range=func_config['domain_range']))
+            zeta = np.squeeze(self.get_var('zeta', time_steps, numpy=True, domain_range=func_config['domain_range']))
+        with self.profiler.section('calc_Enstrophy.compute'):
+            enstrophy = self._enstrophy_field(xi, eta, zeta)
+        with self.profiler.section('calc_Enstrophy.reduce'):
+            return self._mean(enstrophy)
 
+    @cached_diagnostic
     def calc_w_th(self, time_steps, func_config):
         """
         Calculate the covariance of vertical velocity (w) and potential temperature (theta).
@@ -74,125 +652,896 @@ class VVMTools_BL(DataRetriever):
         :param func_config: Configuration dictionary with domain range.
         :return: Mean w'θ' over the domain at each time step.
         """
-        # Get vertical velocity and regrid to center points
-        w = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=func_config['domain_range']))
-        w_regrid = (w[1:]+w[:-1])/2
-
-        # Calculate w' (perturbation of w)
-        w_mean = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=(None,None,None,None,None,None)))
-        w_mean = (w_mean[1:]+w_mean[:-1])/2
-        w_mean = np.mean(w_mean,axis=(1,2)).reshape(w_mean.shape[0],1,1)
-        w_prime = w_regrid - w_mean
-
-        # Get potential temperature (theta) and calculate θ' (theta perturbation)
-        th = np.squeeze(self.get_var('th', time_steps, numpy=True, domain_range=func_config['domain_range']))[1:]
-        th_mean = np.squeeze(self.get_var('th', time_steps, numpy=True, domain_range=(None,None,None,None,None,None)))[1:]
-        th_mean = np.mean(th_mean,axis=(1,2)).reshape(th_mean.shape[0],1,1)
-        th_prime = th - th_mean
-
-        # Calculate the covariance w'θ' and return the mean over the domain
-        w_th = np.mean(w_prime*th_prime,axis=(1,2))
-        return w_th
+        if self.READ_LEVELS and ('w', int(time_steps)) not in (self.var_cache or ()):
+            return self._w_th_on_read(time_steps, func_config)
+
+        # Get vertical velocity and potential temperature on the full domain, needed for the means
+        with self.profiler.section('calc_w_th.read'):
+            w = np.squeeze(self.get_var('w', time_steps, numpy=True, domain_range=(None,None,None,None,None,None)))
+            th = np.squeeze(self.get_var('th', time_steps, numpy=True, domain_range=(None,None,None,None,None,None)))
+
+        # Calculate w'θ' and return its mean over the subdomain
+        with self.profiler.section('calc_w_th.compute'):
+            w_th = self._w_th_field(w, th)
+        with self.profiler.section('calc_w_th.reduce'):
+            return self._mean(w_th[self._region_slices(func_config['domain_range'], w.shape, (1, 0, 0))], skipna=False)
+
+    def _w_th_on_read(self, t, func_config):
+        """
+        calc_w_th reduced on read: w and th are read in blocks of full-domain 
+        levels, and every block is regridded, turned into perturbations of 
+        its level means and reduced over the subdomain before the next one is 
+        read. Each block carries the top level of the previous one along, 
+        which regridding w needs.
+        """
+        shape = self.catalog.shape('w')[1:]
+        z_slice, y_slice, x_slice = self._region_slices(func_config['domain_range'], shape, (1, 0, 0))
+        # Regridded level m lies between the w levels m and m + 1 and at th level m + 1
+        read_range = (z_slice.start, z_slice.stop + 1, None, None, None, None)
+
+        profile = []
+        below = None
+        for (_, w), (_, th) in zip(self.iter_levels('w', t, read_range), self.iter_levels('th', t, read_range)):
+            if below is not None:
+                w, th = np.concatenate([below[0], w]), np.concatenate([below[1], th])
+            below = (w[-1:], th[-1:])
+            if len(w) < 2:
+                continue
+            with self.profiler.section('calc_w_th.compute'):
+                w_th = self._w_th_field(w, th)
+            with self.profiler.section('calc_w_th.reduce'):
+                profile.append(self._mean(w_th[:, y_slice, x_slice], skipna=False))
+        return np.concatenate(profile) if profile else np.empty(0)
+
+    @cached_diagnostic
+    def calc_scalar_fluxes(self, time_steps, func_config):
+        """
+        Calculate the turbulent fluxes (e.g. w'φ') of many scalars (θ, tracers) 
+        in one pass.
+
+        Every velocity component is read, regridded to cell centers and turned 
+        into a perturbation once; every scalar is then read once and its 
+        perturbation multiplied with each velocity perturbation. Perturbations 
+        are taken from the full-domain means, as in calc_w_th, so 
+        `{"scalars": ["th"]}` gives exactly calc_w_th.
+
+        Example:
+            >>> func_config = {"scalars": ["tr01", "tr02", "tr03", "NO", "NO2"], 
+            >>>                "domain_range": (None, None, None, None, 64, 128)}
+            >>> w_tr = myTool.func_time_parallel(myTool.calc_scalar_fluxes, np.arange(721), func_config)
+
+        :param time_steps: Time step to compute the fluxes at.
+        :param func_config: Configuration dictionary with "scalars", a list of variable names, 
+                            the domain range, "regions" or "mask" (see calc_BL_diagnostics), and 
+                            optionally "components", any of 'w', 'u' and 'v'.
+        :return: Mean fluxes of shape (scalar, z), or (scalar, region, z) with "regions" or "mask", 
+                 with a leading component axis if "components" is given.
+        """
+        scalars = list(func_config['scalars'])
+        components = list(func_config.get('components', ('w',)))
+        unknown = set(components) - set(FLUX_COMPONENTS)
+        if unknown:
+            raise ValueError(f"Unknown flux components {sorted(unknown)}, choose from {tuple(FLUX_COMPONENTS)}.")
+        full_range = (None,None,None,None,None,None)
+        read = lambda var: np.squeeze(self.get_var(var, time_steps, numpy=True, domain_range=full_range))
+
+        # Velocity perturbations at cell centers, computed once for all scalars
+        primes = {}
+        for component in components:
+            axis, drop = FLUX_COMPONENTS[component]
+            with self.profiler.section('calc_scalar_fluxes.read'):
+                velocity = read(component)
+            with self.profiler.section('calc_scalar_fluxes.compute'):
+                prime = face_to_center(velocity, axis, drop_first=drop, 
+                                       out=self._workspace.get(f'{component}_prime', center_shape(velocity.shape, drop), 
+                                                               self._compute_dtype(velocity)))
+                prime -= self._mean(prime, skipna=False)[:, np.newaxis, np.newaxis]
+            primes[component] = prime
+        shape = velocity.shape
+
+        fluxes = [[] for _ in components]
+        for scalar in scalars:
+            with self.profiler.section('calc_scalar_fluxes.read'):
+                phi = read(scalar)[1:]
+            dtype = self._compute_dtype(phi, *primes.values())
+            with self.profiler.section('calc_scalar_fluxes.compute'):
+                phi_prime = np.subtract(phi, self._mean(phi, skipna=False)[:, np.newaxis, np.newaxis], 
+                                        out=self._workspace.get('phi_prime', phi.shape, dtype))
+            for i, component in enumerate(components):
+                drop = FLUX_COMPONENTS[component][1]
+                with self.profiler.section('calc_scalar_fluxes.compute'):
+                    flux = np.multiply(primes[component], phi_prime[:, drop[1]:, drop[2]:], 
+                                       out=self._workspace.get('flux', primes[component].shape, dtype))
+                with self.profiler.section('calc_scalar_fluxes.reduce'):
+                    fluxes[i].append(self._reduce_regions(flux, shape, drop, False, func_config))
+
+        fluxes = np.array(fluxes)
+        if not self._has_regions(func_config):
+            fluxes = fluxes[:, :, 0]
+        if 'components' not in func_config:
+            fluxes = fluxes[0]
+        return fluxes
+
+    def calc_moments(self, time_steps, func_config, window=1, cores=20):
+        """
+        Calculate vertical profiles of horizontal central moments (variance, 
+        skewness, kurtosis) of several variables, e.g. σ²(w), skewness of w 
+        and θ variance, reading every variable once per time step.
+
+        Each time step yields a mergeable Moments state per variable, level 
+        and region; states are merged over time windows in the main process, 
+        so window statistics never go back to the raw data.
+
+        Example:
+            >>> moments = myTool.calc_moments(np.arange(721), {"variables": ["w", "th"], "regions": regions}, window=30)
+            >>> sigma2_w, skew_w = moments["w"].variance, moments["w"].skewness  # (window, region, z)
+
+        :param time_steps: A single time step, or a list/array of time steps computed in parallel.
+        :param func_config: Configuration dictionary with "variables", a list of variable names, 
+                            and the domain range, "regions" or "mask" (see calc_BL_diagnostics). 
+                            Moments are taken on each variable's own grid.
+        :param window: Number of consecutive time steps merged into one state, None to merge all.
+        :param cores: Number of processes used when `time_steps` is a list/array.
+        :return: Dictionary mapping each variable to a Moments state with arrays of shape 
+                 (z), or (region, z) with "regions" or "mask", with a leading window axis 
+                 when several time steps are given.
+        """
+        if np.ndim(time_steps) == 0:
+            return {var: Moments.from_array(packed) for var, packed in self._moments_step(time_steps, func_config).items()}
+
+        time_steps = list(np.asarray(time_steps).tolist())
+        step = partial(profiled_task, self.profiler, self._moments_step, func_config=func_config)
+        with self.profiler.section('calc_moments.pool'):
+            with multiprocessing.Pool(processes=cores) as pool:
+                results = self._gather(pool.map(step, time_steps))
+
+        window = window or len(time_steps)
+        moments = {}
+        for var in func_config['variables']:
+            # Packed states (5, time, ...), merged over each window of time steps
+            packed = np.stack([result[var] for result in results], axis=1)
+            windows = [Moments.from_array(packed[:, start:start + window]).combine(axis=0).to_array() 
+                       for start in range(0, len(time_steps), window)]
+            moments[var] = Moments.from_array(np.stack(windows, axis=1))
+        return moments
+
+    @cached_diagnostic
+    def _moments_step(self, t, func_config):
+        """
+        Packed Moments states (5, [region,] z) of every variable of calc_moments at one time step.
+        """
+        full_range = (None,None,None,None,None,None)
+        results = {}
+        for var in func_config['variables']:
+            with self.profiler.section('calc_moments.read'):
+                field = np.squeeze(self.get_var(var, t, numpy=True, domain_range=full_range))
+            with self.profiler.section('calc_moments.reduce'):
+                if 'mask' in func_config:
+                    # All labels in one pass, moved from the last axis to (region, z)
+                    packed = np.moveaxis(self._mask_reducer(func_config['mask']).moments(field).to_array(), -1, 1)
+                else:
+                    packed = np.stack([Moments.from_field(field[self._region_slices(region, field.shape)]).to_array() 
+                                       for region in self._box_regions(func_config)], axis=1)
+                    if 'regions' not in func_config:
+                        packed = packed[:, 0]
+            results[var] = packed
+        return results
+
+    def calc_joint_histogram(self, time_steps, func_config, cores=20):
+        """
+        Accumulate per-level joint histograms of a velocity component (w by 
+        default) and a scalar (θ or a tracer) over many time steps.
+
+        The velocity is averaged to the cell centers of the scalar as in 
+        calc_scalar_fluxes. Bins are fixed, so every time step adds its counts 
+        from one vectorized bincount over all levels (and all mask labels); 
+        each worker sums a chunk of time steps holding one time step in memory, 
+        and the chunk histograms are summed in the main process as they arrive.
+
+        Example:
+            >>> func_config = {"scalar": "th", "bins": (np.linspace(-3, 3, 61), np.linspace(-1, 1, 41)), 
+            >>>                "anomaly": True, "regions": regions}
+            >>> counts = myTool.calc_joint_histogram(np.arange(721), func_config)
+            >>> pdf = counts / counts.sum(axis=(-2, -1), keepdims=True)
+
+        :param time_steps: A single time step or a list/array of time steps.
+        :param func_config: Configuration dictionary with "scalar", "bins" (velocity bin edges, 
+                            scalar bin edges), optionally "component" ('w', 'u' or 'v') and 
+                            "anomaly" (bin the deviations from the full-domain horizontal means), 
+                            and the domain range, "regions" or "mask" (see calc_BL_diagnostics).
+        :param cores: Number of processes.
+        :return: Integer counts of shape (z, n_velocity_bins, n_scalar_bins), with a leading 
+                 region axis with "regions" or "mask", summed over the time steps.
+        """
+        component = func_config.get('component', 'w')
+        if component not in FLUX_COMPONENTS:
+            raise ValueError(f"Unknown velocity component {component!r}, choose from {tuple(FLUX_COMPONENTS)}.")
+        time_steps = list(np.atleast_1d(np.asarray(time_steps)).tolist())
+        if len(time_steps) == 1:
+            return self._histogram_chunk(time_steps, func_config)
+
+        # Chunks of time steps, about four per worker, so partial sums stay few
+        chunk_size = max(1, int(np.ceil(len(time_steps) / (4 * cores))))
+        chunks = [time_steps[i:i + chunk_size] for i in range(0, len(time_steps), chunk_size)]
+        task = partial(profiled_task, self.profiler, self._histogram_chunk, func_config=func_config)
+        counts = None
+        with self.profiler.section('calc_joint_histogram.pool'):
+            with multiprocessing.Pool(processes=cores) as pool:
+                for chunk_counts, snapshot, seconds in pool.imap_unordered(task, chunks):
+                    self.profiler.merge(snapshot, seconds)
+                    counts = chunk_counts if counts is None else counts + chunk_counts
+        return counts
+
+    def _histogram_chunk(self, time_chunk, func_config):
+        """
+        Joint histogram of calc_joint_histogram summed over a chunk of time steps.
+        """
+        counts = None
+        for t in time_chunk:
+            step_counts = self._histogram_step(t, func_config)
+            counts = step_counts if counts is None else counts + step_counts
+        return counts
+
+    def _histogram_step(self, t, func_config):
+        """
+        Joint histogram of calc_joint_histogram at one time step.
+        """
+        component = func_config.get('component', 'w')
+        axis, drop = FLUX_COMPONENTS[component]
+        x_edges, y_edges = func_config['bins']
+        full_range = (None,None,None,None,None,None)
+        with self.profiler.section('calc_joint_histogram.read'):
+            velocity = np.squeeze(self.get_var(component, t, numpy=True, domain_range=full_range))
+            scalar = np.squeeze(self.get_var(func_config['scalar'], t, numpy=True, domain_range=full_range))
+
+        with self.profiler.section('calc_joint_histogram.compute'):
+            shape = center_shape(velocity.shape, drop)
+            x = face_to_center(velocity, axis, drop_first=drop, 
+                               out=self._workspace.get('hist_velocity', shape, self._compute_dtype(velocity)))
+            y = scalar[drop[0]:, drop[1]:, drop[2]:]
+            if func_config.get('anomaly', False):
+                x -= self._mean(x, skipna=False)[:, np.newaxis, np.newaxis]
+                y = np.subtract(y, self._mean(y, skipna=False)[:, np.newaxis, np.newaxis], 
+                                out=self._workspace.get('hist_scalar', y.shape, self._compute_dtype(y)))
+
+            if 'mask' in func_config:
+                counts = self._mask_reducer(func_config['mask']).joint_histogram(x, y, x_edges, y_edges, drop[1:])
+                return np.moveaxis(counts, 1, 0)
+
+            # Group the points of each box region by level
+            counts = []
+            for region in self._box_regions(func_config):
+                slices = self._region_slices(region, velocity.shape, drop)
+                x_region, y_region = x[slices], y[slices]
+                levels = np.broadcast_to(np.arange(x_region.shape[0])[:, np.newaxis, np.newaxis], x_region.shape)
+                counts.append(joint_histogram(x_region, y_region, x_edges, y_edges, levels, x_region.shape[0]))
+        if not self._has_regions(func_config):
+            return counts[0]
+        return np.array(counts)
+
+    def calc_BL_diagnostics(self, time_steps, func_config, which=BL_DIAGNOSTICS, cores=20):
+        """
+        Calculate several boundary layer diagnostics together, reading each 
+        variable only once per time step.
+
+        This replaces separate `get_var_parallel('th', ...)` and 
+        `func_time_parallel` calls of calc_TKE, calc_Enstrophy and calc_w_th, 
+        which open every time step file once per diagnostic. Every variable 
+        is read once over the full domain, regridded once, and reduced over 
+        the subdomain, so `w` and `th` also serve the full-domain means of w'θ'.
+
+        If `func_config` has a "regions" entry instead of "domain_range", 
+        the regridded fields are reduced over each region, e.g.
+        `{"regions": {"domain": (None,)*6, "ocean": (None,None,None,None,0,64)}}`.
+        The profiles then carry a region axis in the order of the regions. 
+        All regions must share the same vertical range. Irregular regions 
+        (land use, coastlines, cloud masks) are given as `{"mask": labels}` 
+        with an integer (y, x) array of labels on the raw grid, negative for 
+        no region; the region axis then follows `mask_labels(labels)` and 
+        all labels are reduced in one pass over each field.
+
+        Enstrophy is computed from the vorticity output, or from the curl of 
+        the velocities when the case has none or func_config has 
+        `{"vorticity": "derived"}`; the velocities are then read once for TKE, 
+        enstrophy and the kinematic diagnostics 'Divergence' and 
+        'ShearProduction' (-u'w' ∂U/∂z - v'w' ∂V/∂z, see curl and divergence).
+
+        :param time_steps: A single time step, or a list/array of time steps computed in parallel.
+        :param func_config: Configuration dictionary with domain range, a "regions" dictionary mapping region names to domain ranges, or a "mask" of region labels.
+        :param which: Diagnostics to compute, any of 'th', 'TKE', 'Enstrophy', 'w_th', 'Divergence' 
+                      and 'ShearProduction'.
+        :param cores: Number of processes used when `time_steps` is a list/array.
+        :return: Dictionary mapping each diagnostic to its horizontal mean profile (z), 
+                 or (region, z) with "regions" or "mask", stacked along a leading time axis 
+                 when several time steps are given.
+        """
+        which = tuple(which)
+        unknown = set(which) - set(BL_DIAGNOSTICS + KINEMATIC_DIAGNOSTICS)
+        if unknown:
+            raise ValueError(f"Unknown diagnostics {sorted(unknown)}, choose from {BL_DIAGNOSTICS + KINEMATIC_DIAGNOSTICS}.")
+
+        if np.ndim(time_steps) == 0:
+            return self._BL_diagnostics_step(time_steps, func_config=func_config, which=which)
+
+        # One task per time step, each returning all requested profiles
+        step = partial(profiled_task, self.profiler, self._BL_diagnostics_step, func_config=func_config, which=which)
+        with self.profiler.section('calc_BL_diagnostics.pool'):
+            with multiprocessing.Pool(processes=cores) as pool:
+                results = self._gather(pool.map(step, list(np.asarray(time_steps).tolist())))
+        return {name: np.array([result[name] for result in results]) for name in which}
+
+    def func_time_parallel(self, func, time_steps=None, func_config=None, cores=5):
+        """
+        Apply `func(t, func_config=func_config)` in parallel over time steps, 
+        see DataRetriever.func_time_parallel.
+
+        With profiling enabled, the timings recorded by `func` in the worker 
+        processes are merged into `self.profiler`, and the wall time of the 
+        whole pool is recorded, so the time lost to scheduling and to 
+        pickling results back shows up against the summed worker times.
+        """
+        if not self.profiler.enabled:
+            return super().func_time_parallel(func, time_steps, func_config, cores)
+
+        if time_steps is None:
+            time_steps = np.arange(0, 721, 1)
+        if type(time_steps) == np.ndarray:
+            time_steps = time_steps.tolist()
+        if not isinstance(time_steps, (list, tuple)):
+            raise TypeError("time_steps must be a list or tuple of integers.")
+
+        task = partial(profiled_task, self.profiler, func, func_config=func_config)
+        with self.profiler.section(f'{getattr(func, "__name__", "func")}.pool'):
+            with multiprocessing.Pool(processes=cores) as pool:
+                results = self._gather(pool.map(task, time_steps))
+        return np.squeeze(np.array(results))
+
+    @contextmanager
+    def func_time_shared(self, func, shape, time_steps=None, func_config=None, dtype=np.float64, cores=5):
+        """
+        Apply `func(t, func_config=func_config)` in parallel over time steps 
+        like func_time_parallel, for functions returning large arrays (e.g. 
+        Hovmöller slices or 2D fields for spectra).
+
+        The output (time, *shape) is allocated in shared memory, and every 
+        worker writes its result in place into its row, so no result is 
+        pickled back, no list of results is stacked and nothing is copied. 
+        The with block owns the segment: it yields a view over the output 
+        and releases the segment on exit, so the view must not be used after 
+        the block; copy what has to outlive it.
+
+        Example:
+            >>> def xt_slice(t, func_config):
+            >>>     return myTool.get_var("NO", t, numpy=True, domain_range=func_config["domain_range"], 
+            >>>                           compute_mean=True, axis=(0, 1))
+            >>> with myTool.func_time_shared(xt_slice, (nx,), np.arange(721), 
+            >>>                              {"domain_range": (0, 1, None, None, None, None)}) as hov:
+            >>>     spectrum = np.abs(np.fft.rfft(hov, axis=-1))**2
+
+        :param func: Function of the time step and func_config returning an array of 
+                     shape `shape` at every time step.
+        :param shape: Shape of the result of one time step.
+        :param time_steps: List or array of time steps, by default all 721.
+        :param func_config: Configuration dictionary passed to `func`.
+        :param dtype: Dtype of the output, the results are cast to it.
+        :param cores: Number of processes.
+        :return: Context manager yielding the array (time, ...) of the results, squeezed 
+                 like func_time_parallel.
+        """
+        if time_steps is None:
+            time_steps = np.arange(0, 721, 1)
+        if type(time_steps) == np.ndarray:
+            time_steps = time_steps.tolist()
+        if not isinstance(time_steps, (list, tuple)):
+            raise TypeError("time_steps must be a list or tuple of integers.")
+
+        shape = (len(time_steps),) + ((int(shape),) if np.ndim(shape) == 0 else tuple(shape))
+        dtype = np.dtype(dtype)
+        segment = shared_memory.SharedMemory(create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        try:
+            output = np.ndarray(shape, dtype=dtype, buffer=segment.buf)
+            task = partial(profiled_task, self.profiler, _shared_step, func, segment.name, shape, dtype.str, 
+                           func_config=func_config)
+            with self.profiler.section(f'{getattr(func, "__name__", "func")}.pool'):
+                with multiprocessing.Pool(processes=cores) as pool:
+                    self._gather(pool.starmap(task, list(enumerate(time_steps))))
+            yield np.squeeze(output)
+        finally:
+            segment.close()
+            segment.unlink()
+
+    def _gather(self, outputs):
+        """
+        Merge the worker profiles of profiled_task outputs into `self.profiler` 
+        and return the plain results.
+        """
+        results = []
+        for result, snapshot, seconds in outputs:
+            self.profiler.merge(snapshot, seconds)
+            results.append(result)
+        return results
+
+    @cached_diagnostic
+    def _BL_diagnostics_step(self, t, func_config, which=BL_DIAGNOSTICS):
+        """
+        Compute the requested diagnostics of calc_BL_diagnostics for one time 
+        step, for the domain range or every region in func_config.
+        """
+        full_range = (None,None,None,None,None,None)
+
+        def read(var):
+            with self.profiler.section('BL_diagnostics.read'):
+                return np.squeeze(self.get_var(var, t, numpy=True, domain_range=full_range))
+
+        def reduce(field, shape, offset, skipna):
+            with self.profiler.section('BL_diagnostics.reduce'):
+                return self._reduce_regions(field, shape, offset, skipna, func_config)
+
+        profiles = {}
+        derived_enstrophy = 'Enstrophy' in which and self._derive_vorticity(func_config)
+        need_velocities = derived_enstrophy or 'TKE' in which or any(name in which for name in KINEMATIC_DIAGNOSTICS)
+        w = read('w') if (need_velocities or 'w_th' in which) else None
+        th = read('th') if ('th' in which or 'w_th' in which) else None
+        if need_velocities:
+            u = read('u')
+            v = read('v')
+
+        if 'th' in which:
+            profiles['th'] = reduce(th, th.shape, (0, 0, 0), False)
+        if 'TKE' in which:
+            with self.profiler.section('BL_diagnostics.compute.TKE'):
+                TKE = self._TKE_field(u, v, w)
+            profiles['TKE'] = reduce(TKE, w.shape, (1, 1, 1), True)
+        if derived_enstrophy:
+            with self.profiler.section('BL_diagnostics.compute.Enstrophy'):
+                enstrophy = self._derived_enstrophy_field(u, v, w)
+            profiles['Enstrophy'] = reduce(enstrophy, w.shape, (1, 1, 1), True)
+        elif 'Enstrophy' in which:
+            xi = read('xi')
+            eta = read(self._eta_name())
+            zeta = read('zeta')
+            with self.profiler.section('BL_diagnostics.compute.Enstrophy'):
+                enstrophy = self._enstrophy_field(xi, eta, zeta)
+            profiles['Enstrophy'] = reduce(enstrophy, xi.shape, (1, 1, 1), True)
+        if 'w_th' in which:
+            with self.profiler.section('BL_diagnostics.compute.w_th'):
+                w_th = self._w_th_field(w, th)
+            profiles['w_th'] = reduce(w_th, w.shape, (1, 0, 0), False)
+        if 'Divergence' in which:
+            with self.profiler.section('BL_diagnostics.compute.Divergence'):
+                div = self.divergence(u, v, w)
+            profiles['Divergence'] = reduce(div, w.shape, (1, 1, 1), True)
+        if 'ShearProduction' in which:
+            with self.profiler.section('BL_diagnostics.compute.ShearProduction'):
+                production = self._shear_production_field(u, v, w)
+            profiles['ShearProduction'] = reduce(production, w.shape, (1, 1, 1), True)
+
+        if not self._has_regions(func_config):
+            return {name: profiles[name][0] for name in which}
+        return {name: profiles[name] for name in which}
+
+    @staticmethod
+    def _has_regions(func_config):
+        """
+        Whether func_config asks for several regions, giving profiles a region axis.
+        """
+        return 'regions' in func_config or 'mask' in func_config
+
+    def _mask_reducer(self, mask):
+        """
+        MaskReducer of a region mask, built once per distinct mask.
+        """
+        mask = np.asarray(mask)
+        key = (mask.shape, mask.dtype.str, hashlib.sha1(np.ascontiguousarray(mask).tobytes()).hexdigest())
+        if key not in self._mask_reducers:
+            self._mask_reducers[key] = MaskReducer(mask)
+        return self._mask_reducers[key]
+
+    def mask_labels(self, mask):
+        """
+        Region labels of a mask, in the order of the region axis of the profiles.
+        """
+        return self._mask_reducer(mask).labels
+
+    def _reduce_regions(self, field, shape, offset, skipna, func_config):
+        """
+        Horizontal means of a field regridded on the full domain over every 
+        region of func_config: each label of "mask", each box of "regions", 
+        or the single "domain_range".
+
+        :param field: Regridded field (z, y, x).
+        :param shape: Shape of the raw full-domain field.
+        :param offset: Points dropped at the start of each axis by regridding.
+        :return: Array (region, z).
+        """
+        if 'mask' in func_config:
+            # One bincount pass over the field for all labels
+            means = self._mask_reducer(func_config['mask']).mean(field, offset[1:], skipna=skipna, 
+                                                                dtype=np.float64 if self.PRECISION else None)
+            return np.moveaxis(means, -1, 0)
+        return np.array([self._mean(field[self._region_slices(region, shape, offset)], skipna=skipna) 
+                         for region in self._box_regions(func_config)])
+
+    @staticmethod
+    def _box_regions(func_config):
+        """
+        Domain ranges of the "regions" of func_config, or its single "domain_range".
+        """
+        if 'regions' in func_config:
+            return list(dict(func_config['regions']).values())
+        return [func_config['domain_range']]
     
 
+    def save_diagnostics(self, store_path, diags, time_steps, func_config, append=False):
+        """
+        Write the profiles returned by calc_BL_diagnostics to a DiagnosticStore, 
+        together with the time steps, region names and provenance, so later 
+        analyses can memory-map them instead of touching the VVM output.
+
+        :param store_path: Directory of the store of this case, or an open DiagnosticStore.
+        :param diags: Dictionary mapping diagnostic names to arrays of shape 
+                      (time, z), or (time, region, z) with "regions".
+        :param time_steps: Time steps of the leading axis.
+        :param func_config: The configuration the diagnostics were computed with.
+        :param append: Append along time to existing variables instead of replacing them.
+        :return: The DiagnosticStore.
+        """
+        store = store_path if isinstance(store_path, DiagnosticStore) else DiagnosticStore(store_path)
+        time_steps = np.atleast_1d(np.asarray(time_steps))
+        if 'mask' in func_config:
+            dims = ('time', 'region', 'z')
+            store.set_coords(region=self.mask_labels(func_config['mask']))
+            store.write('region_mask', np.asarray(func_config['mask']), dims=('y', 'x'))
+            func_config = {key: value for key, value in func_config.items() if key != 'mask'}
+        elif 'regions' in func_config:
+            dims = ('time', 'region', 'z')
+            store.set_coords(region=list(func_config['regions']))
+        else:
+            dims = ('time', 'z')
+        store.set_attrs(**provenance(case_path=os.path.abspath(self.CASEPATH), func_config=func_config,
+                                     precision=str(self.PRECISION)))
+
+        for name, data in {'time': time_steps, **diags}.items():
+            if append and name in store:
+                store.append(name, data)
+            else:
+                store.write(name, data, dims=('time',) if name == 'time' else dims)
+        return store
+
+    def follow(self, store_path, func_config, which=BL_DIAGNOSTICS, heights=None, last_step=None, 
+               poll_interval=60., settle_time=30., timeout=None, cores=20):
+        """
+        Follow a running simulation: poll the case directory for newly 
+        completed time steps, compute the diagnostics of only those steps 
+        and append them, with their boundary layer heights, to the store.
+
+        Steps already in the store are skipped, so a restarted follower 
+        resumes where it stopped. Each refresh costs O(new steps).
+
+        Example:
+            >>> heights = {"h_TKE": ("TKE", "threshold", 0.08), "h_wth": ("w_th", "wth", 1e-3)}
+            >>> for steps, new in myTool.follow("./store/S1", {"regions": regions}, heights=heights, last_step=720):
+            >>>     print(steps[-1], new["h_TKE"][-1])
+
+        :param store_path: Directory of the DiagnosticStore of this case, see save_diagnostics.
+        :param func_config: Configuration dictionary with domain range or "regions", see calc_BL_diagnostics.
+        :param which: Diagnostics to compute.
+        :param heights: Optional dictionary mapping names to (diagnostic, howToSearch, threshold) 
+                        arguments of find_BL_boundary. "wth" heights get a trailing axis of 
+                        the lower, mid and upper boundary.
+        :param last_step: Stop after this time step, e.g. 720. By default follow until `timeout`.
+        :param poll_interval: Seconds between looks at the case directory.
+        :param settle_time: Seconds a time step's files must be unmodified to count as complete.
+        :param timeout: Stop after this many seconds without new time steps, None to wait forever.
+        :param cores: Maximum number of processes used per refresh.
+        :return: Generator of (new time steps, dictionary of their profiles and heights).
+        """
+        heights = heights or {}
+        store = DiagnosticStore(store_path)
+        start = int(store.read('time')[-1]) + 1 if 'time' in store and store.info('time')['shape'][0] > 0 else 0
+        base_dims = ('time', 'region') if self._has_regions(func_config) else ('time',)
+        idle_since = time.time()
+
+        while last_step is None or start <= last_step:
+            steps = self._completed_steps(start, settle_time)
+            if last_step is not None:
+                steps = [t for t in steps if t <= last_step]
+            if not steps:
+                if timeout is not None and time.time() - idle_since > timeout:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            if len(steps) == 1:
+                diags = {name: profile[np.newaxis] 
+                         for name, profile in self.calc_BL_diagnostics(steps[0], func_config, which).items()}
+            else:
+                diags = self.calc_BL_diagnostics(steps, func_config, which, cores=min(cores, len(steps)))
+            self.save_diagnostics(store, diags, steps, func_config, append=True)
+
+            # Heights only depend on the profile of their own time step
+            new = dict(diags)
+            for name, (diagnostic, howToSearch, threshold) in heights.items():
+                h = self.find_BL_boundary(diags[diagnostic], howToSearch, threshold)
+                if howToSearch == "wth":
+                    h, dims = np.moveaxis(h, 0, -1), base_dims + ('boundary',)
+                else:
+                    dims = base_dims
+                if name in store:
+                    store.append(name, h)
+                else:
+                    store.write(name, h, dims=dims)
+                new[name] = h
+
+            start = steps[-1] + 1
+            idle_since = time.time()
+            yield np.asarray(steps), new
+
+    @staticmethod
+    def load_diagnostics(store_path):
+        """
+        Open the diagnostics written by save_diagnostics.
+
+        :param store_path: Directory of the store of this case.
+        :return: Dictionary mapping variable names, including 'time', to read-only np.memmap arrays.
+        """
+        return DiagnosticStore(store_path).read_all()
+
+    def get_hovmoller(self, variables, time_steps, domain_range=(None, None, None, None, None, None), axis=None, 
+                      derived=None, anomaly=None, cores=20):
+        """
+        Extract Hovmöller slices of several variables in one pass over the time steps.
+
+        Each worker opens every output file of a time step once, slices all 
+        requested variables stored in it, reduces them like `get_var(..., 
+        compute_mean=True, axis=axis)` and computes the derived fields, so 
+        only the small reduced slices travel back to the main process.
+
+        Example:
+            >>> def NOx(fields):
+            >>>     return fields["NO"] + fields["NO2"]
+            >>> hov = myTool.get_hovmoller(["NO", "NO2", "u"], np.arange(721), 
+            >>>                            domain_range=(0,1,None,None,None,None), axis=0, 
+            >>>                            derived={"NOx": NOx}, anomaly={"NOx_prime": "NOx"})
+            >>> hov["NOx_prime"].shape  # (721, nx), deviation of hov["NOx"] from the x-mean at each time
+
+        :param variables: List of variable names to read.
+        :param time_steps: A single time step, or a list/array of time steps computed in parallel.
+        :param domain_range: Tuple (k1, k2, j1, j2, i1, i2) shared by all variables.
+        :param axis: Axis or axes of the squeezed slice to average over, None to keep the slice.
+        :param derived: Optional dictionary mapping new names to functions of the dictionary of 
+                        reduced slices, holding the variables and the derived names before 
+                        them. The functions are sent to the worker processes, so they must be 
+                        picklable, e.g. module-level functions or functools.partial of them.
+        :param anomaly: Optional dictionary mapping new names to the variable or derived name 
+                        whose deviation from the mean over the last (x) axis they hold, next 
+                        to the field itself. A list of names replaces those fields by their 
+                        deviation instead.
+        :param cores: Number of processes used when `time_steps` is a list/array.
+        :return: Dictionary mapping every variable and derived name to an array with a 
+                 leading time axis (or without it for a single time step).
+        """
+        variables = list(variables)
+        for var in variables:
+            if self._get_variable_file_type(var) in ("TOPO", "Variable not found"):
+                raise ValueError(f"Variable {var} is not a time-dependent output variable of {self.CASEPATH}.")
+        self._Range_tuple_check(domain_range)
+        if np.size(time_steps) == 0:
+            raise ValueError("time_steps is empty.")
+        derived = dict(derived or {})
+        for name, func in derived.items():
+            if not callable(func):
+                raise TypeError(f"Derived field {name!r} must be a function of the slices, got {func!r}.")
+            try:
+                pickle.dumps(func)
+            except Exception as e:
+                raise TypeError(f"Derived field {name!r} must be picklable, e.g. a module-level function: {e}") from e
+        anomaly = dict(anomaly) if isinstance(anomaly, dict) else {name: name for name in anomaly or ()}
+        fields = variables + list(derived)
+        unknown = set(anomaly.values()) - set(fields)
+        if unknown:
+            raise ValueError(f"Unknown anomaly fields {sorted(unknown)}, choose from {fields}.")
+        taken = {name for name, source in anomaly.items() if name != source and name in fields}
+        if taken:
+            raise ValueError(f"Anomaly names {sorted(taken)} are already variable or derived names.")
+        func_config = {'variables': variables, 'domain_range': tuple(domain_range), 'axis': axis, 
+                       'derived': derived, 'anomaly': anomaly}
+
+        if np.ndim(time_steps) == 0:
+            return self._hovmoller_step(time_steps, func_config)
+
+        step = partial(profiled_task, self.profiler, self._hovmoller_step, func_config=func_config)
+        with self.profiler.section('get_hovmoller.pool'):
+            with multiprocessing.Pool(processes=cores) as pool:
+                results = self._gather(pool.map(step, list(np.asarray(time_steps).tolist())))
+        return {name: np.array([result[name] for result in results]) for name in results[0]}
+
+    @cached_diagnostic
+    def _hovmoller_step(self, t, func_config):
+        """
+        Read, reduce and combine the slices of get_hovmoller for one time step.
+        """
+        k1, k2, j1, j2, i1, i2 = func_config['domain_range']
+        axis = func_config['axis']
+
+        # Group the variables by output file, each file is opened once
+        by_type = {}
+        for var in func_config['variables']:
+            by_type.setdefault(self._get_variable_file_type(var), []).append(var)
+
+        fields = {}
+        for variable_type, names in by_type.items():
+            path = self.catalog.file_path(names[0], t)
+            if path is None or not os.path.exists(path):
+                raise FileNotFoundError(f"No {variable_type} file found for time step {t} in {self.CASEPATH}.")
+            with self.profiler.section('get_hovmoller.read'):
+                with xr.open_dataset(path) as ds:
+                    for var in names:
+                        variable = ds[self.catalog.info(var)['source']]
+                        if variable.ndim == 4:
+                            data = variable[0, k1:k2, j1:j2, i1:i2].to_numpy()
+                        else:
+                            data = variable[0, j1:j2, i1:i2].to_numpy()
+                        self.profiler.add_bytes(var, data.nbytes)
+                        data = np.squeeze(data)
+                        fields[var] = np.mean(data, axis=axis) if axis is not None else data
+
+        with self.profiler.section('get_hovmoller.compute'):
+            # Derived fields may use the variables and the derived fields before them
+            for name, func in func_config['derived'].items():
+                fields[name] = np.asarray(func(dict(fields)))
+            for name, source in func_config['anomaly'].items():
+                fields[name] = fields[source] - np.mean(fields[source], axis=-1, keepdims=True)
+        return fields
+
+    def _get_zc_km(self):
+        """
+        Height levels (zc) in kilometers, taken from the catalog only once.
+        """
+        if self._zc_km is None:
+            self._zc_km = self.catalog.coord("zc")/1000
+        return self._zc_km
+
+    @profiled('find_BL_boundary')
     def find_BL_boundary(self, var, howToSearch, threshold=0.01):
         """
         Calculate the boundary layer height based on specified search criteria.
 
-        :param var: Array of the variable used to define the boundary layer (e.g., potential temperature θ).
+        All methods are vectorized along the last (z) axis, so `var` may carry 
+        any leading batch dimensions, e.g. (case, region, time, z).
+
+        :param var: Array of the variable used to define the boundary layer (e.g., potential temperature θ), with z as the last axis.
         :param howToSearch: String defining the boundary search method. Options are:
                             - "th_plus05K": Height where θ exceeds surface value by 0.5K.
                             - "dthdz": Height where the vertical gradient of θ is maximum.
                             - "threshold": Height where `var` first exceeds the threshold value.
                             - "wth": Boundary levels based on transitions in vertical heat flux.
         :param threshold: Threshold value used in the "threshold" and "wth" methods (default is 0.01).
-        :return: Array of boundary layer heights for each time step or, for "wth", an array with lower, mid, and upper boundaries.
+        :return: Array of boundary layer heights with the batch shape of `var` or, for "wth", 
+                 an array with lower, mid, and upper boundaries stacked along a new leading axis.
         """
         # Get height levels (zc) in kilometers
-        zc = (self.get_var("zc", 0).to_numpy()/1000)
+        zc = self._get_zc_km()
+        var = np.asarray(var)
 
         if howToSearch == "th_plus05K":
-            # Find the height where theta exceeds surface value by 0.5K
-            th_find = abs(var - (var[:, 0].reshape(var.shape[0], 1) + 0.5))
-
-            # Identify boundary layer height for each time step
-            h_BL_th_plus05 = []
-            for t in range(len(th_find)):
-                #h_BL_th_plus05.append(zc[np.where(th_find[t] < threshold)[0][-1]]) 
-                h_BL_th_plus05.append(zc[np.argmin(th_find[t])])         
-            return np.array(h_BL_th_plus05)
+            # Height where theta is closest to the surface value plus 0.5K
+            th_find = abs(var - (var[..., :1] + 0.5))
+            return zc[np.argmin(th_find, axis=-1)]
 
         elif howToSearch == "dthdz":
-            # Compute vertical gradient of theta (dθ/dz)
-            dth_dz = (var[:, 1:] - var[:, :-1]) / (zc[1:] - zc[:-1])
-            
-            # Determine height of maximum gradient for each time step
-            zc = zc[1:]
-            h_BL_dthdz = []
-            for t in range(len(dth_dz)):
-                h_BL_dthdz.append(zc[np.argmax(dth_dz[t])])            
-            return np.array(h_BL_dthdz)
+            # Height of the maximum vertical gradient of theta (dθ/dz)
+            dth_dz = (var[..., 1:] - var[..., :-1]) / (zc[1:] - zc[:-1])
+            return zc[1:][np.argmax(dth_dz, axis=-1)]
 
         elif howToSearch == "threshold":
-            # Identify height where 'var' crosses the threshold
-            positive_mask = np.swapaxes(var, 0, 1) > threshold
-            index = np.argwhere(positive_mask)
-            
-            # Map each time step to the highest index where the threshold is crossed
-            k, i = index[:, 0], index[:, 1]
-            i_k_map = {}
-            
-            for ii in range(len(i)):
-                if i[ii] not in i_k_map:
-                    i_k_map[i[ii]] = k[ii]
-                else:
-                    if k[ii] > i_k_map[i[ii]]:
-                        i_k_map[i[ii]] = k[ii]
-            
-            # Compute boundary layer height for each time step based on threshold crossings
-            zc = zc[1:]
-            h = np.zeros(len(var))
-            for key, value in i_k_map.items():
-                h[key] = zc[value]
-            return np.array(h)
+            # Highest level where 'var' exceeds the threshold, zero if it never does
+            positive_mask = var > threshold
+            k_top = var.shape[-1] - 1 - np.argmax(positive_mask[..., ::-1], axis=-1)
+            return np.where(positive_mask.any(axis=-1), zc[1:][k_top], 0.)
 
         elif howToSearch == "wth":
             # Identify lower, middle, and upper boundaries based on vertical heat flux transitions
-            mask = np.where(var>=0,1,-1)
-            zc_wth = np.zeros((3,var.shape[0]))
-            zc = zc[1:]
-            for t in range(var.shape[0]):
-                temp = mask[t,1:] - mask[t,:-1]
-
-                # Default zero boundary if w'θ' values are low
-                if np.max(var[t])<threshold:
-                    k_lower = k_mid = k_upper = 0
-                
-                # Find lower, mid, and upper boundaries based on transitions
-                else:
-                    # Find lower boundary
-                    try:
-                        k_lower = np.argwhere(temp==-2)[0][0]
-                    except: 
-                        k_lower = 0
-                    
-                    # Find mid boundary
-                    k_mid = np.argmin(var[t])
-                    
-                    # Find upper boundary
-                    try:
-                        k_upper = np.argwhere(temp==2)[0][0]
-                    except:
-                        k_upper = 0
-                
-                # Zero out upper boundary if max value beyond mid-boundary is low
-                if np.max(var[t, np.argmin(var[t]):]) < threshold:
-                    k_upper = 0
-
-                # Store the boundaries for this time step
-                zc_wth[0,t], zc_wth[1,t], zc_wth[2,t] = zc[k_lower], zc[k_mid], zc[k_upper]            
-            return zc_wth
+            k_lower, k_mid, k_upper, var_max, tail_max = self._wth_levels(var)
+            return self._wth_heights(k_lower, k_mid, k_upper, var_max, tail_max, threshold)
 
         else:
             print("Without this searching approach")
-    
\ No newline at end of file
+
+    @staticmethod
+    def _wth_levels(var):
+        """
+        Threshold-independent part of the "wth" search along the last axis.
+
+        :param var: Array of w'θ' profiles with z as the last axis.
+        :return: Level indices of the first sign change to negative (lower), 
+                 the minimum (mid) and the first sign change back to positive 
+                 (upper), plus the profile maximum and the maximum above the 
+                 minimum, which are compared against the threshold.
+        """
+        # Sign transitions of w'θ': -2 for + to -, 2 for - to +
+        mask = np.where(var>=0,1,-1)
+        temp = mask[..., 1:] - mask[..., :-1]
+
+        # First transition of each kind, zero when there is none
+        down, up = temp == -2, temp == 2
+        k_lower = np.where(down.any(axis=-1), np.argmax(down, axis=-1), 0)
+        k_upper = np.where(up.any(axis=-1), np.argmax(up, axis=-1), 0)
+        k_mid = np.argmin(var, axis=-1)
+
+        # Maximum of the whole profile and of the part above the minimum
+        above_mid = np.arange(var.shape[-1]) >= k_mid[..., np.newaxis]
+        var_max = np.max(var, axis=-1)
+        tail_max = np.max(np.where(above_mid, var, -np.inf), axis=-1)
+        return k_lower, k_mid, k_upper, var_max, tail_max
+
+    def _wth_heights(self, k_lower, k_mid, k_upper, var_max, tail_max, threshold):
+        """
+        Apply the "wth" threshold to the levels from _wth_levels and convert 
+        them to heights of shape (3, ...).
+        """
+        zc = self._get_zc_km()[1:]
+
+        # Default zero boundary if w'θ' values are low
+        weak = var_max < threshold
+        k_lower = np.where(weak, 0, k_lower)
+        k_mid = np.where(weak, 0, k_mid)
+
+        # Zero out upper boundary if max value beyond mid-boundary is low
+        k_upper = np.where(weak | (tail_max < threshold), 0, k_upper)
+        return np.stack([zc[k_lower], zc[k_mid], zc[k_upper]])
+
+    @profiled('find_BL_boundary_sweep')
+    def find_BL_boundary_sweep(self, var, howToSearch, thresholds):
+        """
+        Calculate boundary layer heights for many thresholds at once, giving 
+        the same result as calling find_BL_boundary once per threshold.
+
+        Each profile is scanned only once: "threshold" takes the running 
+        maximum of the profile from the top down, locates it among the sorted 
+        thresholds and accumulates the number of levels above each threshold, 
+        and "wth" reuses the threshold-independent levels for every threshold.
+
+        :param var: Array of the variable used to define the boundary layer, with z as the last axis.
+        :param howToSearch: "threshold" or "wth", see find_BL_boundary.
+        :param thresholds: 1D array of threshold values.
+        :return: Heights of shape (n_thresholds, ...) for "threshold", or 
+                 (n_thresholds, 3, ...) for "wth".
+        """
+        var = np.asarray(var)
+        thresholds = np.asarray(thresholds, dtype=float).ravel()
+
+        if howToSearch == "threshold":
+            zc = self._get_zc_km()[1:]
+            n_thr = len(thresholds)
+
+            # Running maximum from the top: the highest level above a threshold is 
+            # the number of levels whose running maximum exceeds it, minus one
+            top_max = np.fmax.accumulate(var[..., ::-1], axis=-1)[..., ::-1]
+
+            # Locate every running maximum among the sorted thresholds in one pass; 
+            # level k lies above the first n_below[k] sorted thresholds
+            order = np.argsort(thresholds, kind='stable')
+            n_below = np.searchsorted(thresholds[order], top_max, side='left')
+            n_below = np.where(np.isnan(top_max), 0, n_below).reshape(-1, var.shape[-1])
+
+            # Count the levels above each sorted threshold with a per-profile 
+            # histogram of n_below and a cumulative sum from the top
+            n_profiles = n_below.shape[0]
+            offsets = np.arange(n_profiles)[:, np.newaxis] * (n_thr + 1)
+            hist = np.bincount((n_below + offsets).ravel(), minlength=n_profiles*(n_thr + 1))
+            hist = hist.reshape(n_profiles, n_thr + 1)
+            count_sorted = np.cumsum(hist[:, :0:-1], axis=-1)[:, ::-1]
+            count = np.empty_like(count_sorted)
+            count[:, order] = count_sorted
+            count = count.reshape(var.shape[:-1] + (n_thr,))
+
+            h = np.where(count > 0, zc[np.maximum(count - 1, 0)], 0.)
+            return np.moveaxis(h, -1, 0)
+
+        elif howToSearch == "wth":
+            levels = self._wth_levels(var)
+            return np.stack([self._wth_heights(*levels, threshold) for threshold in thresholds])
+
+        else:
+            raise ValueError(f"Threshold sweep is only available for 'threshold' and 'wth', not {howToSearch!r}.")
@@ -0,0 +1,287 @@
+from collections import OrderedDict
+import functools
+import hashlib
+import importlib.util
+import inspect
+import os
+import tempfile
+import numpy as np
+
+class DiagnosticCache:
+    """
+    An on-disk cache of per-time-step diagnostic results, stored as one
+    `.npz` file per entry.
+
+    Entries are keyed by case path, method name, compute precision, function
+    configuration, time step and the modification times of the source files (the case
+    output files of that time step, the Python file defining the method and the
+    kernel modules computing the fields),
+    so rewriting either gives a new key and the stale entry is never served.
+    The total size is bounded by evicting least recently used entries.
+    """
+    def __init__(self, cache_dir, max_bytes=2**30):
+        """
+        :param cache_dir: Directory holding the cache entries, created if missing.
+        :param max_bytes: Upper bound of the total size of all entries in bytes.
+        """
+        self.CACHEDIR = cache_dir
+        self.MAX_BYTES = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+
+        os.makedirs(self.CACHEDIR, exist_ok=True)
+
+    def __getstate__(self):
+        # Size estimates and counters are per process, start fresh in workers
+        state = self.__dict__.copy()
+        state.update(hits=0, misses=0, _size=None)
+        return state
+
+    def make_key(self, *parts):
+        """
+        Hash any nesting of dicts, lists, tuples, NumPy arrays and scalars into a key.
+        """
+        h = hashlib.sha1()
+        _update_hash(h, parts)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.CACHEDIR, f'{key}.npz')
+
+    def get(self, key):
+        """
+        Load an entry, returning None on a miss.
+
+        :return: The stored array, dictionary of arrays, or None.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                if '__array__' in data.files:
+                    result = data['__array__']
+                else:
+                    result = {name: data[name] for name in data.files}
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+
+        # Mark as recently used for the eviction order
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return result
+
+    def put(self, key, result):
+        """
+        Store an array or a dictionary of arrays, then evict old entries if
+        the cache grew beyond its size bound.
+        """
+        arrays = result if isinstance(result, dict) else {'__array__': result}
+
+        # Write to a temporary file first so concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.CACHEDIR, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+
+        if self._size is None:
+            self._size = sum(size for _, size, _ in self._entries())
+        else:
+            self._size += os.path.getsize(self._path(key))
+        if self._size > self.MAX_BYTES:
+            self.evict()
+
+    def _entries(self):
+        """
+        List (path, size, last use) of all entries.
+        """
+        entries = []
+        for entry in os.scandir(self.CACHEDIR):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry.path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits in MAX_BYTES.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        size = sum(size for _, size, _ in entries)
+        for path, entry_size, _ in entries:
+            if size <= self.MAX_BYTES:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+        self._size = size
+
+    def clear(self):
+        """
+        Remove every entry, e.g. after changing code the keys do not track.
+        """
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._size = 0
+
+    def stats(self):
+        """
+        :return: Dictionary with hits, misses, number of entries and total bytes.
+        """
+        entries = self._entries()
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries)}
+
+
+class VariableCache:
+    """
+    An in-memory least-recently-used cache of full-domain variable reads,
+    bounded by the total number of bytes held.
+
+    Cached arrays are made read-only, since get_var hands out views of them.
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        """
+        :param max_bytes: Upper bound of the total size of cached arrays in bytes.
+        """
+        self.MAX_BYTES = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def __getstate__(self):
+        # Do not ship cached arrays to worker processes
+        state = self.__dict__.copy()
+        state.update(hits=0, misses=0, _entries=OrderedDict(), _size=0)
+        return state
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        :return: The cached array, or None on a miss.
+        """
+        data = self._entries.get(key)
+        if data is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def put(self, key, data):
+        """
+        Store an array, evicting least recently used arrays to stay within MAX_BYTES.
+        Arrays larger than the whole cache are not stored.
+        """
+        if data.nbytes > self.MAX_BYTES:
+            return
+        data.flags.writeable = False
+        if key in self._entries:
+            self._size -= self._entries.pop(key).nbytes
+        self._entries[key] = data
+        self._size += data.nbytes
+        while self._size > self.MAX_BYTES:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= evicted.nbytes
+
+    def clear(self):
+        """
+        Drop all cached arrays.
+        """
+        self._entries.clear()
+        self._size = 0
+
+    def stats(self):
+        """
+        :return: Dictionary with hits, misses, number of entries and total bytes.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self._entries), 'bytes': self._size}
+
+
+def _update_hash(h, obj):
+    """
+    Feed a stable representation of `obj` into the hash object `h`.
+    """
+    if isinstance(obj, dict):
+        h.update(b'{')
+        for key in sorted(obj, key=repr):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+        h.update(b'}')
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'(')
+        for item in obj:
+            _update_hash(h, item)
+        h.update(b')')
+    elif isinstance(obj, np.ndarray):
+        h.update(f'array{obj.dtype.str}{obj.shape}'.encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, np.generic):
+        _update_hash(h, obj.item())
+    elif isinstance(obj, functools.partial):
+        _update_hash(h, ('partial', obj.func, obj.args, obj.keywords))
+    elif hasattr(obj, '__code__'):
+        # Functions, e.g. derived fields, by name and compiled code rather than by address
+        code = obj.__code__
+        _update_hash(h, ('function', obj.__module__, obj.__qualname__, code.co_code, repr(code.co_consts)))
+    else:
+        h.update(repr(obj).encode())
+        h.update(b',')
+
+
+# Modules whose code computes the cached diagnostics besides the decorated method's own module
+CODE_MODULES = ('VVMkernels', 'VVMcatalog')
+
+def cached_diagnostic(method):
+    """
+    Decorator for per-time-step VVMTools_BL methods `method(self, t, func_config, ...)`,
+    serving results from `self.diagnostic_cache` when it is set.
+
+    Calls with several time steps at once and instances without a cache
+    run the method unchanged. Editing the method's module or any of 
+    CODE_MODULES invalidates its entries.
+    """
+    source_files = [inspect.getsourcefile(method)] + [importlib.util.find_spec(name).origin for name in CODE_MODULES]
+
+    @functools.wraps(method)
+    def wrapper(self, t, func_config, *args, **kwargs):
+        cache = getattr(self, 'diagnostic_cache', None)
+        if cache is None or np.ndim(t) != 0:
+            return method(self, t, func_config, *args, **kwargs)
+
+        sources = [(path, os.stat(path).st_mtime_ns) for path in sorted(self._timestep_files(t))]
+        sources.extend((path, os.stat(path).st_mtime_ns) for path in source_files)
+        key = cache.make_key(os.path.abspath(self.CASEPATH), method.__qualname__,
+                             str(getattr(self, 'PRECISION', None)), func_config, int(t), args, kwargs, sources)
+
+        profiler = getattr(self, 'profiler', None)
+        result = cache.get(key)
+        if result is None:
+            if profiler is not None:
+                profiler.count('diagnostic_cache.miss')
+            result = method(self, t, func_config, *args, **kwargs)
+            cache.put(key, result)
+        elif profiler is not None:
+            profiler.count('diagnostic_cache.hit')
+        return result
+    return wrapper
@@ -0,0 +1,138 @@
+from VVManalyze import VVMTools_BL, BL_DIAGNOSTICS
+from VVMprofile import profiled_task
+import multiprocessing
+import numpy as np
+
+# VVMTools_BL instances of the current worker process, keyed by case name
+_WORKER_TOOLS = {}
+
+def _init_worker(tools):
+    """
+    Pool initializer: keep the case tools resident for the life of the worker,
+    so their caches and buffers are reused across tasks.
+    """
+    _WORKER_TOOLS.update(tools)
+
+def _run_task(task):
+    """
+    Compute the BL diagnostics of one (case, time step chunk) task.
+    """
+    case, index, time_chunk, func_config, which = task
+    tool = _WORKER_TOOLS[case]
+    step = lambda: [tool._BL_diagnostics_step(t, func_config=func_config, which=which) for t in time_chunk]
+    results, snapshot, seconds = profiled_task(tool.profiler, step)
+    return case, index, results, snapshot, seconds
+
+
+class BLCampaign:
+    """
+    Run the boundary layer diagnostics of a whole campaign of cases on one
+    persistent process pool.
+
+    Every case is split into (case, time step chunk) tasks, which are handed
+    out dynamically so all workers stay busy across case boundaries instead
+    of starting a new pool per case and diagnostic. Results are written
+    back into per-case arrays.
+
+    Example:
+        >>> regions = {"domain": (None,)*6, "ocean": (None,None,None,None,0,64)}
+        >>> with BLCampaign({"S1": path_s1, "S2": path_s2}, regions, cores=20) as campaign:
+        >>>     for case, diags in campaign.iter_cases(np.arange(721)):
+        >>>         h = campaign.tools[case].find_BL_boundary(diags["TKE"], "threshold", 0.08)
+    """
+    def __init__(self, cases, regions, which=BL_DIAGNOSTICS, cores=20, chunk_size=None, tool_kwargs=None):
+        """
+        :param cases: Dictionary mapping case names to case paths, or a list of case paths.
+        :param regions: Dictionary mapping region names to domain ranges, or an integer (y, x) 
+                        array of region labels, see VVMTools_BL.calc_BL_diagnostics.
+        :param which: Diagnostics to compute, any of 'th', 'TKE', 'Enstrophy', 'w_th', 'Divergence' 
+                      and 'ShearProduction'.
+        :param cores: Number of worker processes.
+        :param chunk_size: Number of time steps per task. By default each case is
+                           split into about four tasks per worker.
+        :param tool_kwargs: Keyword arguments for VVMTools_BL, e.g. {'cache_dir': './cache/'}.
+        """
+        if not isinstance(cases, dict):
+            cases = {path: path for path in cases}
+        self.CASES = dict(cases)
+        self.FUNC_CONFIG = {"mask": regions} if isinstance(regions, np.ndarray) else {"regions": dict(regions)}
+        self.WHICH = tuple(which)
+        self.CORES = cores
+        self.CHUNK_SIZE = chunk_size
+        self.tools = {case: VVMTools_BL(path, **(tool_kwargs or {})) for case, path in self.CASES.items()}
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is not None and self._pool is not None:
+            # Do not wait for the remaining tasks of a failed run
+            self._pool.terminate()
+        self.close()
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.CORES, initializer=_init_worker, initargs=(self.tools,))
+        return self._pool
+
+    def close(self):
+        """
+        Shut down the worker pool.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _tasks(self, time_steps):
+        """
+        Split every case into (case, chunk index, time steps, func_config, which) tasks.
+        """
+        chunk_size = self.CHUNK_SIZE or max(1, int(np.ceil(len(time_steps) / (4 * self.CORES))))
+        chunks = [time_steps[i:i + chunk_size] for i in range(0, len(time_steps), chunk_size)]
+        return [(case, index, chunk, self.FUNC_CONFIG, self.WHICH)
+                for case in self.CASES for index, chunk in enumerate(chunks)], chunk_size
+
+    def iter_cases(self, time_steps):
+        """
+        Compute all cases on the pool, yielding each case as soon as all its
+        tasks are done, so BL heights and figures can be produced in the main
+        process while the workers continue with the remaining cases.
+
+        :param time_steps: List or array of time steps.
+        :return: Generator of (case name, dictionary mapping each diagnostic to an
+                 array of shape (time, region, z)).
+        """
+        time_steps = list(np.asarray(time_steps).tolist())
+        tasks, chunk_size = self._tasks(time_steps)
+        remaining = {case: 0 for case in self.CASES}
+        for task in tasks:
+            remaining[task[0]] += 1
+
+        results = {}
+        for case, index, chunk_results, snapshot, seconds in self._get_pool().imap_unordered(_run_task, tasks):
+            # Worker timings of profiled tools add up in the tool of the main process
+            self.tools[case].profiler.merge(snapshot, seconds)
+
+            # Allocate the per-case arrays from the first returned profiles
+            if case not in results:
+                results[case] = {name: np.empty((len(time_steps),) + np.shape(profile), dtype=np.result_type(profile))
+                                 for name, profile in chunk_results[0].items()}
+            start = index * chunk_size
+            for name, array in results[case].items():
+                array[start:start + len(chunk_results)] = [result[name] for result in chunk_results]
+
+            remaining[case] -= 1
+            if remaining[case] == 0:
+                yield case, results.pop(case)
+
+    def run(self, time_steps):
+        """
+        Compute all cases on the pool.
+
+        :param time_steps: List or array of time steps.
+        :return: Dictionary mapping case names to dictionaries of diagnostics,
+                 each of shape (time, region, z).
+        """
+        return dict(self.iter_cases(time_steps))
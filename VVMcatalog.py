@@ -0,0 +1,192 @@
+import json
+import os
+import tempfile
+import numpy as np
+import xarray as xr
+
+# Bumped whenever the layout of the catalog changes, so older catalogs are rebuilt
+CATALOG_VERSION = 1
+
+# Time step suffix of the output file names, e.g. S1.L.Dynamic-000000.nc
+_FIRST_STEP_SUFFIX = '000000.nc'
+
+# Location of the staggered variables on the Arakawa C grid, other (z, y, x) fields are at cell centers
+STAGGER = {'u': 'x_face', 'v': 'y_face', 'w': 'z_face',
+           'xi': 'yz_edge', 'eta': 'xz_edge', 'eta_2': 'xz_edge', 'zeta': 'xy_edge'}
+
+class CaseCatalog:
+    """
+    A persistent index of the output of one case.
+
+    For every variable the catalog records the file type holding it, the
+    file name pattern of its time steps, its dimensions, shape, dtype and
+    location on the C grid; it also keeps the coordinate arrays of the
+    output files and the initial profile of fort.98. It is built once from
+    an initialized DataRetriever and saved as JSON, so reopening a case
+    needs no probe reads of the NetCDF files. A saved catalog is only used
+    while the files it was built from keep their size and modification time.
+
+    Example:
+        >>> catalog = CaseCatalog.load("catalog.json", case_path) or CaseCatalog.build(tool)
+        >>> catalog.info("eta")
+        {'type': 'Dynamic', 'source': 'eta', 'dims': ['time', 'zc', 'yc', 'xc'], 'shape': [1, 50, 128, 128], ...}
+        >>> catalog.file_path("th", 42)
+        '/path/to/case/archive/S1.L.Thermodynamic-000042.nc'
+    """
+    def __init__(self, case_path, variables, coords, init, sources):
+        """
+        :param case_path: Path to the case simulation data.
+        :param variables: Dictionary mapping variable names to their description.
+        :param coords: Dictionary mapping coordinate names to 1-D arrays.
+        :param init: Initial profile of fort.98, see DataRetriever.INIT.
+        :param sources: Dictionary mapping the files the catalog was built from,
+                        relative to the case path, to their [size, mtime_ns].
+        """
+        self.CASEPATH = case_path
+        self.variables = variables
+        self.coords = coords
+        self.init = init
+        self.sources = sources
+
+    @classmethod
+    def build(cls, tool):
+        """
+        Catalog the case of an initialized DataRetriever, opening the first
+        output file of every file type once.
+
+        :param tool: DataRetriever whose VARTYPE and INIT are filled.
+        """
+        case_path = tool.CASEPATH
+
+        # First output file of every file type, in the walk order DataRetriever.get_var searches
+        first_files = {}
+        for root, dirs, files in os.walk(case_path):
+            for filename in files:
+                _, variable_type, time_info = tool._extract_file_info(filename)
+                if time_info == _FIRST_STEP_SUFFIX[:-3] and variable_type not in first_files:
+                    first_files[variable_type] = os.path.relpath(os.path.join(root, filename), case_path)
+        if os.path.exists(os.path.join(case_path, 'TOPO.nc')):
+            first_files['TOPO'] = 'TOPO.nc'
+
+        variables, coords = {}, {}
+        for variable_type, relpath in first_files.items():
+            names = [name for name, vtype in tool.VARTYPE.items() if vtype == variable_type]
+            with xr.open_dataset(os.path.join(case_path, relpath)) as ds:
+                for name in names:
+                    # DataRetriever renames a variable found in a second file type to <name>_2
+                    source = name[:-2] if name.endswith('_2') and name not in ds.variables else name
+                    if source not in ds.variables:
+                        continue
+                    da = ds[source]
+                    variables[name] = {'type': variable_type, 'source': source, 'file': relpath,
+                                       'dims': list(da.dims), 'shape': list(da.shape), 'dtype': da.dtype.str,
+                                       'stagger': STAGGER.get(name, 'center' if da.ndim >= 3 else 'surface')}
+                for name, coord in ds.coords.items():
+                    if coord.ndim == 1 and name not in coords:
+                        coords[name] = coord.to_numpy()
+
+        sources = {relpath: None for relpath in list(first_files.values()) + ['fort.98']}
+        catalog = cls(case_path, variables, coords, {key: np.asarray(value) for key, value in tool.INIT.items()}, sources)
+        catalog.sources = catalog._stat_sources()
+        return catalog
+
+    def _stat_sources(self):
+        """
+        Current [size, mtime_ns] of every source file, None for missing ones.
+        """
+        stats = {}
+        for relpath in self.sources:
+            try:
+                stat = os.stat(os.path.join(self.CASEPATH, relpath))
+                stats[relpath] = [stat.st_size, stat.st_mtime_ns]
+            except OSError:
+                stats[relpath] = None
+        return stats
+
+    def is_current(self):
+        """
+        Whether all files the catalog was built from are unchanged.
+        """
+        return self._stat_sources() == self.sources
+
+    @classmethod
+    def load(cls, path, case_path):
+        """
+        Load a saved catalog of `case_path`.
+
+        :return: The catalog, or None if there is none, it belongs to another
+                 case, has an older layout or its source files changed.
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get('version') != CATALOG_VERSION or state.get('case_path') != os.path.abspath(case_path):
+            return None
+
+        array = lambda entry: np.asarray(entry['data'], dtype=entry['dtype'])
+        catalog = cls(case_path, state['variables'], {name: array(entry) for name, entry in state['coords'].items()},
+                      {name: array(entry) for name, entry in state['init'].items()},
+                      {relpath: stat for relpath, stat in state['sources'].items()})
+        return catalog if catalog.is_current() else None
+
+    def save(self, path):
+        """
+        Save the catalog as JSON, replacing the file atomically. A directory
+        that cannot be written, e.g. a read-only case directory, is skipped.
+        """
+        entry = lambda array: {'dtype': array.dtype.str, 'data': array.tolist()}
+        state = {'version': CATALOG_VERSION, 'case_path': os.path.abspath(self.CASEPATH),
+                 'variables': self.variables, 'sources': self.sources,
+                 'coords': {name: entry(array) for name, array in self.coords.items()},
+                 'init': {name: entry(array) for name, array in self.init.items()}}
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+    def __contains__(self, name):
+        return name in self.variables
+
+    def vartype(self):
+        """
+        Dictionary mapping variable names to their file type, like DataRetriever.VARTYPE.
+        """
+        return {name: info['type'] for name, info in self.variables.items()}
+
+    def info(self, name):
+        """
+        :return: Dictionary with the file type, name in the file, first file, dims, shape,
+                 dtype and stagger location of a variable.
+        """
+        if name not in self:
+            raise KeyError(f"No variable {name!r} in the catalog of {self.CASEPATH}.")
+        return self.variables[name]
+
+    def shape(self, name):
+        """
+        Shape of a variable in the output files, including the time axis, None if unknown.
+        """
+        return tuple(self.variables[name]['shape']) if name in self else None
+
+    def coord(self, name):
+        """
+        Coordinate array of the output files, e.g. "xc" or "zc".
+        """
+        return self.coords[name]
+
+    def file_path(self, name, t):
+        """
+        Path of the file holding variable `name` at time step `t`, None for
+        variables that are not written per time step (e.g. TOPO).
+        """
+        relpath = self.info(name)['file']
+        if not relpath.endswith(_FIRST_STEP_SUFFIX):
+            return None
+        return os.path.join(self.CASEPATH, f'{relpath[:-len(_FIRST_STEP_SUFFIX)]}{int(t):06d}.nc')
@@ -0,0 +1,448 @@
+"""
+Allocation-free kernels for averaging Arakawa C-grid variables to cell
+centers and reducing them horizontally.
+
+Fields are (z, y, x) arrays. Averaging to cell centers loses one point along
+each averaged axis; `drop_first` gives, for every axis, how many leading
+points are dropped in the result, so all fields of a diagnostic land on the
+same cell-center grid (e.g. (1, 1, 1) for TKE and enstrophy). Only the
+required subarrays are touched and results are written into `out` buffers,
+typically taken from a Workspace.
+"""
+
+import numpy as np
+
+class Workspace:
+    """
+    A set of named, reusable output buffers.
+
+    A buffer is reallocated only when the requested shape or dtype changes,
+    so repeated per-time-step calls reuse the same memory.
+    """
+    def __init__(self):
+        self._buffers = {}
+
+    def __getstate__(self):
+        # Buffers are scratch memory, do not ship them to worker processes
+        return {'_buffers': {}}
+
+    def get(self, name, shape, dtype=np.float64):
+        """
+        :param name: Name of the buffer.
+        :param shape: Required shape.
+        :param dtype: Required dtype.
+        :return: An uninitialized array of the given shape and dtype.
+        """
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+        return buffer
+
+    def clear(self):
+        """
+        Release all buffers.
+        """
+        self._buffers.clear()
+
+
+def _neighbour_slices(ndim, shifts, drop_first):
+    """
+    Index tuple selecting the upper (shift 1) or lower (shift 0) neighbour
+    along the averaged axes in `shifts`, and dropping leading points along
+    the other axes.
+    """
+    index = []
+    for axis in range(ndim):
+        if axis in shifts:
+            index.append(slice(1, None) if shifts[axis] else slice(None, -1))
+        else:
+            index.append(slice(drop_first[axis], None))
+    return tuple(index)
+
+
+def center_shape(shape, drop_first):
+    """
+    Shape of a cell-center field after dropping `drop_first` leading points along each axis.
+    """
+    return tuple(n - drop for n, drop in zip(shape, drop_first))
+
+
+def face_to_center(a, axis, out=None, drop_first=(1, 1, 1)):
+    """
+    Average a face variable (e.g. u, v, w) to cell centers along `axis`.
+
+    :param a: Staggered field.
+    :param axis: Axis along which the variable is staggered.
+    :param out: Optional output buffer of shape center_shape(a.shape, drop_first).
+    :param drop_first: Leading points dropped along each axis of the result.
+    :return: The averaged field, `out` if given.
+    """
+    hi = _neighbour_slices(a.ndim, {axis: 1}, drop_first)
+    lo = _neighbour_slices(a.ndim, {axis: 0}, drop_first)
+    out = np.add(a[hi], a[lo], out=out)
+    out *= 0.5
+    return out
+
+
+def edge_to_center(a, axes, out=None, drop_first=(1, 1, 1)):
+    """
+    Average an edge variable (e.g. a vorticity component) to cell centers
+    with the four-point mean over the two axes in `axes`.
+
+    :param a: Staggered field.
+    :param axes: The two axes along which the variable is staggered.
+    :param out: Optional output buffer of shape center_shape(a.shape, drop_first).
+    :param drop_first: Leading points dropped along each axis of the result.
+    :return: The averaged field, `out` if given.
+    """
+    first, second = axes
+    corners = [(1, 1), (0, 1), (1, 0), (0, 0)]
+    index = [_neighbour_slices(a.ndim, {first: s1, second: s2}, drop_first) for s1, s2 in corners]
+    out = np.add(a[index[0]], a[index[1]], out=out)
+    out += a[index[2]]
+    out += a[index[3]]
+    out *= 0.25
+    return out
+
+
+def forward_difference(a, axis, spacing, out=None, periodic=False):
+    """
+    Difference quotient (a[i+1] - a[i]) / spacing[i] between neighbours along `axis`.
+
+    The result sits half a grid point above `a` along `axis` (e.g. on the u 
+    points for a cell-center field differenced along x) and keeps the shape 
+    of `a`: the last point wraps around to the first one if `periodic`, and 
+    is zero otherwise, as for a vertical derivative at a free-slip lid.
+
+    :param a: Field (z, y, x).
+    :param axis: Axis of the derivative.
+    :param spacing: Grid spacing, a scalar or an array with one distance per point along `axis`.
+    :param out: Optional output buffer of the shape of `a`.
+    :param periodic: Wrap around along `axis`.
+    :return: The difference quotient, `out` if given.
+    """
+    if out is None:
+        out = np.empty(a.shape, dtype=np.result_type(a, 1.))
+    lower = [slice(None)] * a.ndim
+    upper, first, last = list(lower), list(lower), list(lower)
+    lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+    first[axis], last[axis] = slice(None, 1), slice(-1, None)
+    lower, upper, first, last = tuple(lower), tuple(upper), tuple(first), tuple(last)
+
+    np.subtract(a[upper], a[lower], out=out[lower])
+    if periodic:
+        np.subtract(a[first], a[last], out=out[last])
+    else:
+        out[last] = 0
+
+    spacing = np.asarray(spacing)
+    if spacing.ndim:
+        spacing = spacing.reshape((-1,) + (1,) * (a.ndim - 1 - axis % a.ndim))
+    out /= spacing
+    return out
+
+
+def sum_of_squares(fields):
+    """
+    Square every field in place and accumulate them into the first one.
+
+    :param fields: Sequence of arrays of the same shape, overwritten.
+    :return: The first array, holding the sum of squares.
+    """
+    total = np.square(fields[0], out=fields[0])
+    for field in fields[1:]:
+        total += np.square(field, out=field)
+    return total
+
+
+def horizontal_mean(field, skipna=True, dtype=None):
+    """
+    Mean over the last two (y, x) axes.
+
+    The plain sum is computed first; only levels where it is NaN fall back
+    to np.nanmean when `skipna` is set, so fields without NaNs never pay
+    for the NaN-aware reduction.
+
+    :param field: Array with shape (..., ny, nx).
+    :param skipna: Ignore NaNs like np.nanmean instead of propagating them.
+    :param dtype: Optional accumulation dtype, e.g. np.float64 for float32 fields.
+    :return: Array with shape (...).
+    """
+    mean = np.asarray(np.sum(field, axis=(-2, -1), dtype=dtype))
+    mean = np.true_divide(mean, field.shape[-2] * field.shape[-1], out=mean)
+    if skipna:
+        nan_levels = np.isnan(mean)
+        if nan_levels.any():
+            mean[nan_levels] = np.nanmean(field[nan_levels], axis=(-2, -1), dtype=dtype)
+    return mean
+
+
+def bin_index(values, edges):
+    """
+    Bin of every value for increasing bin `edges`, with the same edge 
+    conventions as np.histogram (the last bin includes its right edge).
+    Uniform edges use index arithmetic instead of a search.
+
+    :param values: 1D array.
+    :param edges: Increasing bin edges, n_bins + 1 values.
+    :return: Integer array of bin indices, -1 for values outside the bins or NaN.
+    """
+    values = np.asarray(values)
+    edges = np.asarray(edges, dtype=np.float64)
+    n_bins = len(edges) - 1
+    widths = np.diff(edges)
+    if np.allclose(widths, widths[0]):
+        # Same steps as the uniform-bin path of np.histogram
+        inside = (values >= edges[0]) & (values <= edges[-1])
+        index = np.full(values.shape, -1, dtype=np.intp)
+        scaled = (values[inside] - edges[0]) * (n_bins / (edges[-1] - edges[0]))
+        inner = scaled.astype(np.intp)
+        inner[inner == n_bins] -= 1
+        inner[values[inside] < edges[inner]] -= 1
+        inner[(values[inside] >= edges[inner + 1]) & (inner != n_bins - 1)] += 1
+        index[inside] = inner
+    else:
+        index = np.searchsorted(edges, values, side='right') - 1
+        index[values == edges[-1]] = n_bins - 1
+    index[(index < 0) | (index >= n_bins) | np.isnan(values)] = -1
+    return index
+
+
+def joint_histogram(x, y, x_edges, y_edges, groups, n_groups):
+    """
+    Counts of (x, y) pairs per group and pair of bins, with one bincount 
+    over all points.
+
+    :param x: Array of values.
+    :param y: Array of values of the same size as `x`.
+    :param x_edges: Bin edges of `x`.
+    :param y_edges: Bin edges of `y`.
+    :param groups: Integer array of the same size, e.g. the level of each point, -1 to skip a point.
+    :param n_groups: Number of groups.
+    :return: Integer array (n_groups, n_x_bins, n_y_bins).
+    """
+    n_x, n_y = len(x_edges) - 1, len(y_edges) - 1
+    ix = bin_index(np.ravel(x), x_edges)
+    iy = bin_index(np.ravel(y), y_edges)
+    groups = np.ravel(groups)
+    keep = (ix >= 0) & (iy >= 0) & (groups >= 0)
+    flat = (groups[keep] * n_x + ix[keep]) * n_y + iy[keep]
+    return np.bincount(flat, minlength=n_groups * n_x * n_y).reshape(n_groups, n_x, n_y)
+
+
+class Moments:
+    """
+    Mergeable central moment state: count, mean and the sums of the 2nd to 
+    4th powers of deviations from the mean (M2, M3, M4), element-wise over 
+    arrays of any shape, e.g. one value per level and region.
+
+    States of different chunks (time steps, workers, subdomains) combine 
+    exactly with the parallel formulas of Chan et al. and Pébay, so 
+    moments over time windows or merged regions need no second pass over 
+    the raw data. Accumulation is in float64.
+    """
+    FIELDS = ('n', 'mean', 'm2', 'm3', 'm4')
+
+    def __init__(self, n, mean, m2, m3, m4):
+        self.n, self.mean, self.m2, self.m3, self.m4 = (np.asarray(a, dtype=np.float64) for a in (n, mean, m2, m3, m4))
+
+    @classmethod
+    def from_field(cls, field, axis=(-2, -1)):
+        """
+        Moments of `field` over `axis`, ignoring NaNs.
+
+        :param field: Array, e.g. (z, y, x).
+        :param axis: Axes reduced, by default the horizontal (y, x) axes.
+        """
+        field = np.asarray(field, dtype=np.float64)
+        valid = ~np.isnan(field)
+        if valid.all():
+            mean = np.mean(field, axis=axis)
+            n = np.full(mean.shape, field.size / max(mean.size, 1))
+            deviation = field - np.expand_dims(mean, axis)
+        else:
+            n = np.sum(valid, axis=axis).astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                mean = np.nansum(field, axis=axis) / n
+            deviation = np.where(valid, field - np.expand_dims(mean, axis), 0.)
+        squared = deviation * deviation
+        return cls(n, mean, np.sum(squared, axis=axis), np.sum(squared * deviation, axis=axis), 
+                   np.sum(squared * squared, axis=axis))
+
+    @classmethod
+    def from_array(cls, packed):
+        """
+        Rebuild a state from to_array output, the fields stacked along the first axis.
+        """
+        return cls(*packed)
+
+    def to_array(self):
+        """
+        :return: Array (5, ...) of n, mean, M2, M3 and M4, e.g. for pickling or storing.
+        """
+        return np.stack([self.n, self.mean, self.m2, self.m3, self.m4])
+
+    def combine(self, axis=0):
+        """
+        Merge the states along `axis` into one, e.g. all time steps of a window.
+        """
+        n = np.sum(self.n, axis=axis)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # States without samples have a NaN mean and must not weigh in
+            mean = np.sum(np.where(self.n > 0, self.n * self.mean, 0.), axis=axis) / n
+        delta = np.where(self.n > 0, self.mean - np.expand_dims(mean, axis), 0.)
+        delta2 = delta * delta
+        m2 = np.sum(self.m2 + self.n * delta2, axis=axis)
+        m3 = np.sum(self.m3 + 3 * delta * self.m2 + self.n * delta2 * delta, axis=axis)
+        m4 = np.sum(self.m4 + 4 * delta * self.m3 + 6 * delta2 * self.m2 + self.n * delta2 * delta2, axis=axis)
+        return Moments(n, mean, m2, m3, m4)
+
+    def merge(self, other):
+        """
+        :return: The state of the union of the samples of `self` and `other`.
+        """
+        return Moments.from_array(np.stack([self.to_array(), other.to_array()], axis=1)).combine(axis=0)
+
+    @property
+    def variance(self):
+        """
+        Population variance M2 / n.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.m2 / self.n
+
+    @property
+    def skewness(self):
+        """
+        Skewness sqrt(n) M3 / M2^1.5.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(self.n) * self.m3 / self.m2 ** 1.5
+
+    @property
+    def kurtosis(self):
+        """
+        Excess kurtosis n M4 / M2^2 - 3, zero for a normal distribution.
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.n * self.m4 / (self.m2 * self.m2) - 3
+
+
+class MaskReducer:
+    """
+    Horizontal means over the regions of an integer-labelled (y, x) mask,
+    for all labels at once.
+
+    The flattened bin index of every grid point (level * n_labels + label)
+    is computed once per field layout, so each reduction is a single
+    np.bincount pass over the field, however many regions the mask has.
+    Negative labels mark points that belong to no region.
+    """
+    def __init__(self, mask):
+        """
+        :param mask: Integer array (ny, nx) of region labels on the raw grid.
+        """
+        mask = np.asarray(mask)
+        if mask.ndim != 2 or not np.issubdtype(mask.dtype, np.integer):
+            raise ValueError(f"The region mask must be a 2D integer array, got {mask.ndim}D {mask.dtype}.")
+        self.MASK = mask
+        self.labels = np.unique(mask[mask >= 0])
+        self._bins = {}
+
+    def __getstate__(self):
+        # Bin indices are rebuilt on demand, do not ship them to worker processes
+        state = self.__dict__.copy()
+        state['_bins'] = {}
+        return state
+
+    def _bin_index(self, shape, drop_first):
+        """
+        Bins of a field of `shape` (..., ny', nx') that dropped `drop_first` 
+        leading (y, x) points of the raw grid.
+
+        :return: Tuple of the flattened bin (level * n_labels + label) of every 
+                 point inside a region, the flat indices of those points (None 
+                 if all points are inside), and the number of points per bin.
+        """
+        key = (tuple(shape), tuple(drop_first))
+        if key not in self._bins:
+            dy, dx = drop_first
+            labels = self.MASK[dy:dy + shape[-2], dx:dx + shape[-1]]
+            if labels.shape != tuple(shape[-2:]):
+                raise ValueError(f"The region mask of shape {self.MASK.shape} does not cover a field of shape {shape}.")
+            # Position of each label in self.labels, -1 for unlabelled points
+            region = np.where(labels >= 0, np.searchsorted(self.labels, labels), -1).ravel()
+            n_levels = int(np.prod(shape[:-2], dtype=int))
+            bins = (region + np.arange(n_levels)[:, np.newaxis] * len(self.labels)).ravel()
+            inside = np.flatnonzero(np.tile(region >= 0, n_levels)) if (region < 0).any() else None
+            if inside is not None:
+                bins = bins[inside]
+            counts = np.bincount(bins, minlength=n_levels * len(self.labels))
+            self._bins[key] = (bins, inside, counts)
+        return self._bins[key]
+
+    def mean(self, field, drop_first=(0, 0), skipna=True, dtype=None):
+        """
+        Mean of `field` over every region.
+
+        :param field: Array (..., ny', nx') on the raw grid or regridded from it.
+        :param drop_first: Leading (y, x) points of the raw grid dropped by the regridding.
+        :param skipna: Ignore NaNs like np.nanmean instead of propagating them.
+        :param dtype: Output dtype, by default the dtype of `field`. Sums are accumulated in float64.
+        :return: Array (..., n_labels) in the order of `self.labels`.
+        """
+        bins, inside, counts = self._bin_index(field.shape, drop_first)
+        values = field.ravel() if inside is None else field.ravel()[inside]
+        sums = np.bincount(bins, weights=values, minlength=len(counts))
+        if skipna:
+            nan_points = np.isnan(values)
+            if nan_points.any():
+                # Recount without the NaN points, only when there are any
+                valid = ~nan_points
+                sums = np.bincount(bins[valid], weights=values[valid], minlength=len(counts))
+                counts = np.bincount(bins[valid], minlength=len(counts))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return means.reshape(field.shape[:-2] + (len(self.labels),)).astype(dtype or field.dtype, copy=False)
+
+    def moments(self, field, drop_first=(0, 0)):
+        """
+        Moments of `field` over every region, in one bincount pass per moment.
+
+        :param field: Array (..., ny', nx') on the raw grid or regridded from it.
+        :param drop_first: Leading (y, x) points of the raw grid dropped by the regridding.
+        :return: Moments with arrays of shape (..., n_labels).
+        """
+        bins, inside, counts = self._bin_index(field.shape, drop_first)
+        values = field.ravel() if inside is None else field.ravel()[inside]
+        values = values.astype(np.float64)
+        valid = ~np.isnan(values)
+        if not valid.all():
+            bins, values = bins[valid], values[valid]
+            counts = np.bincount(bins, minlength=len(counts))
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(bins, weights=values, minlength=len(counts)) / counts
+        deviation = values - mean[bins]
+        squared = deviation * deviation
+        sums = [np.bincount(bins, weights=power, minlength=len(counts)) 
+                for power in (squared, squared * deviation, squared * squared)]
+        shape = field.shape[:-2] + (len(self.labels),)
+        return Moments(*(a.reshape(shape) for a in [counts.astype(np.float64), mean] + sums))
+
+    def joint_histogram(self, x, y, x_edges, y_edges, drop_first=(0, 0)):
+        """
+        Joint histograms of `x` and `y` of every region, see joint_histogram.
+
+        :param x: Array (..., ny', nx') on the raw grid or regridded from it.
+        :param y: Array of the same shape as `x`.
+        :param drop_first: Leading (y, x) points of the raw grid dropped by the regridding.
+        :return: Integer array (..., n_labels, n_x_bins, n_y_bins).
+        """
+        shape = x.shape[:-2] + (len(self.labels), len(x_edges) - 1, len(y_edges) - 1)
+        bins, inside, counts = self._bin_index(x.shape, drop_first)
+        x, y = np.ravel(x), np.ravel(y)
+        if inside is not None:
+            x, y = x[inside], y[inside]
+        return joint_histogram(x, y, x_edges, y_edges, bins, len(counts)).reshape(shape)
@@ -0,0 +1,185 @@
+"""
+Opt-in timing, I/O and cache accounting of the analysis hot paths.
+
+A Profiler collects wall times of named sections (e.g. "calc_TKE.read"),
+bytes read per variable and event counters such as cache hits. Worker
+processes send snapshots of their profiler back with their results, which
+are merged into the profiler of the main process, so one summary covers
+the whole run. A disabled profiler turns every call into a no-op.
+"""
+
+from contextlib import contextmanager, nullcontext
+import functools
+import json
+import os
+import time
+
+# Shared no-op context of disabled profilers
+_NULL_SECTION = nullcontext()
+
+class Profiler:
+    """
+    Accumulate section timings, bytes read per variable and counters.
+
+    Example:
+        >>> profiler = Profiler()
+        >>> with profiler.section("calc_TKE.read"):
+        >>>     u = tool.get_var("u", 0, numpy=True)
+        >>> profiler.add_bytes("u", u.nbytes)
+        >>> profiler.dump("profile.json")
+    """
+    def __init__(self, enabled=True):
+        """
+        :param enabled: Record anything at all, False makes every method a no-op.
+        """
+        self.enabled = enabled
+        self.reset()
+
+    def __getstate__(self):
+        # Worker processes start with an empty record
+        return {'enabled': self.enabled, 'sections': {}, 'bytes_read': {}, 'counters': {}, 'processes': {}}
+
+    def reset(self):
+        """
+        Drop everything recorded so far.
+        """
+        # name -> [calls, total seconds, max seconds]
+        self.sections = {}
+        self.bytes_read = {}
+        self.counters = {}
+        # pid -> total seconds spent in tasks, to see the load balance of pools
+        self.processes = {}
+
+    def section(self, name):
+        """
+        Context manager timing the enclosed block under `name`.
+        """
+        if not self.enabled:
+            return _NULL_SECTION
+        return self._section(name)
+
+    @contextmanager
+    def _section(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        entry = self.sections.setdefault(name, [0, 0., 0.])
+        entry[0] += 1
+        entry[1] += seconds
+        entry[2] = max(entry[2], seconds)
+
+    def add_bytes(self, var, nbytes):
+        if self.enabled:
+            self.bytes_read[var] = self.bytes_read.get(var, 0) + int(nbytes)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        """
+        :return: A picklable copy of everything recorded, tagged with the process id.
+        """
+        return {'pid': os.getpid(),
+                'sections': {name: list(entry) for name, entry in self.sections.items()},
+                'bytes_read': dict(self.bytes_read),
+                'counters': dict(self.counters)}
+
+    def merge(self, snapshot, task_seconds=0.):
+        """
+        Add a snapshot taken in another process.
+
+        :param snapshot: Result of Profiler.snapshot.
+        :param task_seconds: Time the process spent on the task, for the load balance.
+        """
+        if not self.enabled or snapshot is None:
+            return
+        for name, (calls, total, longest) in snapshot['sections'].items():
+            entry = self.sections.setdefault(name, [0, 0., 0.])
+            entry[0] += calls
+            entry[1] += total
+            entry[2] = max(entry[2], longest)
+        for var, nbytes in snapshot['bytes_read'].items():
+            self.add_bytes(var, nbytes)
+        for name, n in snapshot['counters'].items():
+            self.count(name, n)
+        pid = snapshot['pid']
+        self.processes[pid] = self.processes.get(pid, 0.) + task_seconds
+
+    def summary(self):
+        """
+        :return: Dictionary with the sections sorted by total time, bytes read
+                 per variable, counters, cache hit rates and per-process task time.
+        """
+        sections = {name: {'calls': calls, 'total': total, 'mean': total / calls if calls else 0.,
+                           'max': longest}
+                    for name, (calls, total, longest) in sorted(self.sections.items(), key=lambda item: -item[1][1])}
+        hit_rates = {}
+        for name in self.counters:
+            cache, _, event = name.rpartition('.')
+            if event in ('hit', 'miss') and cache not in hit_rates:
+                hits = self.counters.get(f'{cache}.hit', 0)
+                hit_rates[cache] = hits / (hits + self.counters.get(f'{cache}.miss', 0))
+        return {'sections': sections,
+                'bytes_read': dict(sorted(self.bytes_read.items(), key=lambda item: -item[1])),
+                'total_bytes_read': sum(self.bytes_read.values()),
+                'counters': dict(self.counters),
+                'cache_hit_rates': hit_rates,
+                'processes': {str(pid): seconds for pid, seconds in self.processes.items()}}
+
+    def flame(self):
+        """
+        :return: Lines in the folded stack format of flame graph tools, one
+                 per section with its total time in microseconds; dotted
+                 section names become stack frames.
+        """
+        return [f"{name.replace('.', ';')} {int(round(total * 1e6))}"
+                for name, (_, total, _) in sorted(self.sections.items())]
+
+    def dump(self, path):
+        """
+        Write the summary as JSON to `path`, and the folded stacks next to it
+        with the extension `.folded`.
+        """
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+        with open(os.path.splitext(path)[0] + '.folded', 'w') as f:
+            f.write('\n'.join(self.flame()) + '\n')
+
+
+def profiled(name):
+    """
+    Method decorator timing every call under section `name` with `self.profiler`,
+    if the instance has one.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            profiler = getattr(self, 'profiler', None)
+            if profiler is None:
+                return method(self, *args, **kwargs)
+            with profiler.section(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def profiled_task(profiler, func, *args, **kwargs):
+    """
+    Run one pool task with a fresh worker profiler.
+
+    :return: Tuple (result of `func`, profiler snapshot, task seconds), with
+             None for the snapshot when the profiler is disabled.
+    """
+    if profiler is None or not profiler.enabled:
+        return func(*args, **kwargs), None, 0.
+    profiler.reset()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, profiler.snapshot(), time.perf_counter() - start
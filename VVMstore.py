@@ -0,0 +1,172 @@
+import datetime
+import json
+import os
+import tempfile
+import numpy as np
+
+class DiagnosticStore:
+    """
+    A columnar on-disk store of computed diagnostics of one case.
+
+    Every variable is a raw C-ordered binary file `<name>.dat` holding the
+    array without header, described in `index.json` by its dtype, shape,
+    dimension names and attributes (e.g. provenance). Variables can grow
+    along their first dimension with append, and are read back as
+    read-only `np.memmap` arrays, so opening a (time, region, z) result
+    costs no more than parsing the index.
+
+    Example:
+        >>> store = DiagnosticStore("./store/S1")
+        >>> store.write("TKE", TKE, dims=("time", "region", "z"), attrs={"units": "m2/s2"})
+        >>> store.append("TKE", TKE_next_day)
+        >>> TKE = store.read("TKE")  # np.memmap of shape (time, region, z)
+    """
+    def __init__(self, path):
+        """
+        :param path: Directory of the store, created if missing.
+        """
+        self.PATH = path
+        os.makedirs(self.PATH, exist_ok=True)
+        self._index = self._load_index()
+
+    def _index_path(self):
+        return os.path.join(self.PATH, 'index.json')
+
+    def _data_path(self, name):
+        return os.path.join(self.PATH, f'{name}.dat')
+
+    def _load_index(self):
+        try:
+            with open(self._index_path()) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {'variables': {}, 'coords': {}, 'attrs': {}}
+
+    def _save_index(self):
+        # Replace the index atomically, so readers never see a partial one
+        fd, tmp_path = tempfile.mkstemp(dir=self.PATH, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._index, f, indent=1)
+        os.replace(tmp_path, self._index_path())
+
+    def __contains__(self, name):
+        return name in self._index['variables']
+
+    @property
+    def variables(self):
+        """
+        Names of the stored variables.
+        """
+        return list(self._index['variables'])
+
+    @property
+    def coords(self):
+        """
+        Dictionary of coordinate labels, e.g. {"region": ["domain", "ocean"]}.
+        """
+        return self._index['coords']
+
+    @property
+    def attrs(self):
+        """
+        Dictionary of store-wide attributes, e.g. the provenance of the case.
+        """
+        return self._index['attrs']
+
+    def info(self, name):
+        """
+        :return: Dictionary with dtype, shape, dims and attrs of a variable.
+        """
+        if name not in self:
+            raise KeyError(f"No variable {name!r} in {self.PATH}, found {self.variables}.")
+        return self._index['variables'][name]
+
+    def set_coords(self, **coords):
+        """
+        Record coordinate labels, e.g. set_coords(region=["domain", "ocean"]).
+        """
+        self._index['coords'].update({dim: np.asarray(labels).tolist() for dim, labels in coords.items()})
+        self._save_index()
+
+    def set_attrs(self, **attrs):
+        """
+        Record store-wide attributes, which must be JSON serializable.
+        """
+        self._index['attrs'].update(attrs)
+        self._save_index()
+
+    def write(self, name, data, dims=None, attrs=None):
+        """
+        Write a variable, replacing an existing one of the same name.
+
+        :param name: Variable name, used as the file name.
+        :param data: Array to store.
+        :param dims: Names of the dimensions of `data`, by default dim_0, dim_1, ...
+        :param attrs: Optional JSON-serializable attributes of the variable.
+        """
+        data = np.ascontiguousarray(data)
+        dims = list(dims) if dims is not None else [f'dim_{i}' for i in range(data.ndim)]
+        if len(dims) != data.ndim:
+            raise ValueError(f"{name} has {data.ndim} dimensions but {len(dims)} dimension names were given.")
+
+        # Write the data before the index entry that makes it visible
+        fd, tmp_path = tempfile.mkstemp(dir=self.PATH, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            data.tofile(f)
+        os.replace(tmp_path, self._data_path(name))
+
+        self._index['variables'][name] = {'dtype': data.dtype.str, 'shape': list(data.shape), 'dims': dims,
+                                          'attrs': dict(attrs or {})}
+        self._save_index()
+
+    def append(self, name, data):
+        """
+        Append `data` along the first dimension of a variable, creating it
+        with default dimension names if it does not exist yet.
+
+        Bytes past the length recorded in the index, e.g. from an interrupted
+        append, are overwritten.
+
+        :param name: Variable name.
+        :param data: Array whose shape after the first dimension and dtype
+                     match the stored variable.
+        """
+        if name not in self:
+            return self.write(name, data)
+
+        info = self.info(name)
+        dtype = np.dtype(info['dtype'])
+        data = np.ascontiguousarray(data, dtype=dtype)
+        if list(data.shape[1:]) != info['shape'][1:]:
+            raise ValueError(f"Cannot append data of shape {data.shape} to {name} of shape {tuple(info['shape'])}.")
+
+        with open(self._data_path(name), 'r+b') as f:
+            f.seek(int(np.prod(info['shape'])) * dtype.itemsize)
+            data.tofile(f)
+            f.truncate()
+        info['shape'][0] += data.shape[0]
+        self._save_index()
+
+    def read(self, name):
+        """
+        :return: The variable as a read-only np.memmap, or an empty array if it has no elements.
+        """
+        info = self.info(name)
+        shape = tuple(info['shape'])
+        if np.prod(shape) == 0:
+            return np.empty(shape, dtype=info['dtype'])
+        return np.memmap(self._data_path(name), dtype=info['dtype'], mode='r', shape=shape)
+
+    def read_all(self):
+        """
+        :return: Dictionary mapping every variable name to its np.memmap.
+        """
+        return {name: self.read(name) for name in self.variables}
+
+
+def provenance(**extra):
+    """
+    Attributes describing how and when diagnostics were produced.
+    """
+    return {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'numpy': np.__version__, **extra}
@@ -0,0 +1,312 @@
+"""
+Benchmark suite for the analysis hot paths.
+
+A synthetic VVM-style case directory is written locally first, so the
+benchmarks need no access to real simulation output. Each diagnostic,
+boundary layer detection mode and plot routine is then timed at several
+sizes and core counts, and the timings are saved as JSON that can be
+compared across commits:
+
+    python benchmark.py --sizes 64x64x30x24 128x128x50x24 --cores 1 4 --output bench_new.json
+    python benchmark.py --compare bench_old.json bench_new.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import numpy as np
+import xarray as xr
+
+# Variables written into each output file type of the synthetic case
+DYNAMIC_VARS = ('u', 'v', 'w', 'xi', 'eta', 'zeta')
+THERMODYNAMIC_VARS = ('th', 'qv')
+TRACER_VARS = ('tr01', 'tr02', 'tr03', 'NO', 'NO2')
+
+def make_synthetic_case(case_path, nx=128, ny=128, nz=50, nt=24, dx=200., dz=40., eta_2=False, seed=0):
+    """
+    Write a synthetic VVM case directory with staggered u, v, w, th,
+    vorticity (xi, eta, zeta) and tracers that DataRetriever can read.
+
+    The fields are random but physically shaped: θ increases with height
+    and has small perturbations, and a convective layer deepens with time,
+    so the boundary layer detection methods find non-trivial heights.
+
+    :param case_path: Directory of the case, created if missing.
+    :param nx: Number of grid points in x.
+    :param ny: Number of grid points in y.
+    :param nz: Number of vertical levels.
+    :param nt: Number of time steps.
+    :param dx: Horizontal grid spacing in meters.
+    :param dz: Vertical grid spacing in meters.
+    :param eta_2: Also write `eta` into a second file type with one level less
+                  in the first one, so the case exercises the `eta_2` lookup.
+    :param seed: Seed of the random fields.
+    :return: The case path.
+    """
+    rng = np.random.default_rng(seed)
+    case_name = os.path.basename(os.path.normpath(case_path))
+    archive = os.path.join(case_path, 'archive')
+    os.makedirs(archive, exist_ok=True)
+
+    # Initial profile in the fort.98 layout parsed by DataRetriever
+    zz = np.arange(nz + 1) * dz
+    zt = np.concatenate([[dz / 2], (zz[1:] + zz[:-1]) / 2])
+    with open(os.path.join(case_path, 'fort.98'), 'w') as f:
+        f.write(' K, ZZ(K), ZT(K)\n ' + '=' * 40 + '\n')
+        for k in range(nz + 1):
+            f.write(f' {k + 1:4d} {zz[k]:12.4f} {zt[k]:12.4f}\n')
+        f.write(' ' + '=' * 40 + '\n K, RHO(K), THBAR(K), PBAR(K), PIBAR(K), QVBAR(K)\n ' + '=' * 40 + '\n')
+        for k in range(nz + 1):
+            f.write(f' {k + 1:4d} {1.2 - 1e-4 * zz[k]:10.5f} {300 + 4e-3 * zz[k]:10.4f} '
+                    f'{1e5 - 11.5 * zz[k]:12.3f} {1 - 1e-4 * zz[k]:10.6f} {0.015:10.6f}\n')
+        f.write(' K, UG(K), VG(K)\n')
+
+    coords = {'time': [0.], 'zc': zz[:nz], 'yc': np.arange(ny) * dx, 'xc': np.arange(nx) * dx}
+    dims = ('time', 'zc', 'yc', 'xc')
+    z = coords['zc'][:, np.newaxis, np.newaxis]
+    for t in range(nt):
+        coords['time'] = [float(t)]
+
+        # Convective layer deepening with time, with turbulence confined below its top
+        h = (0.2 + 0.6 * t / max(nt - 1, 1)) * zz[nz]
+        turbulence = (z < h) * (1 - z / zz[nz])
+        noise = lambda scale: (scale * rng.standard_normal((nz, ny, nx)) * turbulence).astype(np.float32)[np.newaxis]
+
+        dynamic = {name: (dims, noise(1.0)) for name in ('u', 'v', 'w')}
+        dynamic.update({name: (dims, noise(1e-2)) for name in ('xi', 'eta', 'zeta')})
+        dynamic_coords = dict(coords)
+        if eta_2:
+            dynamic['eta'] = (('time', 'zc_eta', 'yc', 'xc'), dynamic['eta'][1][:, :-1])
+            dynamic_coords['zc_eta'] = zz[:nz - 1]
+        th = 300 + 4e-3 * np.maximum(z - h, 0) + 0.1 * rng.standard_normal((nz, ny, nx)) * turbulence
+        thermodynamic = {'th': (dims, th.astype(np.float32)[np.newaxis]), 'qv': (dims, noise(1e-3))}
+        tracer = {name: (dims, np.abs(noise(1.0))) for name in TRACER_VARS}
+
+        files = {'L.Dynamic': xr.Dataset(dynamic, coords=dynamic_coords),
+                 'L.Thermodynamic': xr.Dataset(thermodynamic, coords=coords),
+                 'L.Tracer': xr.Dataset(tracer, coords=coords)}
+        if eta_2:
+            files['L.Vorticity'] = xr.Dataset({'eta': (dims, noise(1e-2))}, coords=coords)
+        for file_type, ds in files.items():
+            ds.to_netcdf(os.path.join(archive, f'{case_name}.{file_type}-{t:06d}.nc'))
+    return case_path
+
+
+def _timeit(func, repeats):
+    """
+    Run `func` `repeats` times and return the timings in seconds.
+    """
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _record(results, name, size, cores, timings, **extra):
+    results.append({'name': name, 'size': size, 'cores': cores,
+                    'min': min(timings), 'median': float(np.median(timings)),
+                    'repeats': len(timings), **extra})
+    print(f'{name:40s} {size:>18s} cores={cores:<3d} min={min(timings):9.4f}s median={np.median(timings):9.4f}s')
+
+
+def bench_diagnostics(case_path, size, cores_list, repeats, results):
+    """
+    Time the calc_* diagnostics per time step in one process and over all
+    time steps in parallel.
+    """
+    from VVManalyze import VVMTools_BL
+
+    tool = VVMTools_BL(case_path)
+    nx = tool.DIM['xc'].size
+    time_steps = np.arange(_count_steps(tool))
+    func_config = {'domain_range': (None, None, None, None, None, None)}
+    regions = {'regions': {'domain': (None,) * 6, 'west': (None, None, None, None, 0, nx // 2),
+                           'east': (None, None, None, None, nx // 2, None)}}
+
+    def cold(func, *args):
+        # Drop cached reads so every repeat decodes the files again
+        def run():
+            if tool.var_cache is not None:
+                tool.var_cache.clear()
+            return func(*args)
+        return run
+
+    # Single process, one time step
+    for name in ('calc_TKE', 'calc_Enstrophy', 'calc_w_th'):
+        timings = _timeit(cold(getattr(tool, name), 0, func_config), repeats)
+        _record(results, f'{name}[step]', size, 1, timings)
+    timings = _timeit(cold(tool.calc_BL_diagnostics, 0, regions), repeats)
+    _record(results, 'calc_BL_diagnostics[step,3 regions]', size, 1, timings)
+
+    # All time steps in parallel
+    for cores in cores_list:
+        for name in ('calc_TKE', 'calc_Enstrophy', 'calc_w_th'):
+            func = getattr(tool, name)
+            timings = _timeit(lambda: tool.func_time_parallel(func, time_steps, func_config, cores=cores), repeats)
+            _record(results, f'{name}[parallel]', size, cores, timings, nt=len(time_steps))
+        timings = _timeit(lambda: tool.calc_BL_diagnostics(time_steps, regions, cores=cores), repeats)
+        _record(results, 'calc_BL_diagnostics[parallel,3 regions]', size, cores, timings, nt=len(time_steps))
+
+
+def _count_steps(tool):
+    """
+    Number of consecutive time steps with output files, starting at 0.
+    """
+    nt = 0
+    while tool._timestep_files(nt):
+        nt += 1
+    return nt
+
+
+def bench_find_BL_boundary(case_path, size, n_profiles, repeats, results):
+    """
+    Time every find_BL_boundary mode and the threshold sweep on random profiles.
+    """
+    from VVManalyze import VVMTools_BL
+
+    tool = VVMTools_BL(case_path)
+    nz = tool.get_var('zc', 0).size
+    rng = np.random.default_rng(0)
+    th = 300 + np.cumsum(np.abs(rng.standard_normal((n_profiles, nz))), axis=-1)
+    tke = np.abs(rng.standard_normal((n_profiles, nz - 1))) * 0.1
+    wth = rng.standard_normal((n_profiles, nz - 1)) * 1e-2
+    thresholds = np.linspace(0.02, 0.2, 37)
+
+    cases = {'th_plus05K': (th, {}), 'dthdz': (th, {}),
+             'threshold': (tke, {'threshold': 0.08}), 'wth': (wth, {'threshold': 1e-3})}
+    for mode, (var, kwargs) in cases.items():
+        timings = _timeit(lambda: tool.find_BL_boundary(var, mode, **kwargs), repeats)
+        _record(results, f'find_BL_boundary[{mode}]', size, 1, timings, n_profiles=n_profiles)
+    timings = _timeit(lambda: tool.find_BL_boundary_sweep(tke, 'threshold', thresholds), repeats)
+    _record(results, 'find_BL_boundary_sweep[threshold,37]', size, 1, timings, n_profiles=n_profiles)
+
+
+def bench_plots(nx, nz, nt, repeats, results, figpath):
+    """
+    Time dataPlotters.draw_zt, draw_xt and draw_zt_batch with the Agg backend, including savefig.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from plottools import dataPlotters
+
+    size = f'{nx}x{nz}x{nt}'
+    x = np.arange(nx) * 0.2
+    z = np.arange(nz) * 0.04
+    t = np.arange(nt) * np.timedelta64(2, 'm') + np.datetime64('2024-01-01 05:00:00')
+    domain = {'x': x, 'y': x, 'z': z, 't': t}
+    units = {'x': 'km', 'y': 'km', 'z': 'km', 't': 'LocalTime'}
+    dplot = dataPlotters('bench', figpath, domain, units)
+
+    rng = np.random.default_rng(0)
+    data_zt = rng.standard_normal((nz, nt)) * 0.02
+    data_xt = rng.standard_normal((nt, nx))
+    pblh = {f'h{i}': rng.uniform(0, z[-1], nt) for i in range(7)}
+
+    def draw_zt():
+        dplot.draw_zt(data_zt, np.arange(-0.04, 0.041, 0.005), 'both', pblh_dicts=pblh, figname='bench_zt.png')
+        plt.close('all')
+
+    def draw_xt():
+        dplot.draw_xt(data_xt, np.arange(-3., 3.001, 0.2), 'both', figname='bench_xt.png')
+        plt.close('all')
+
+    def draw_zt_batch():
+        # Nine panels, like the tracer x region figures of example_pbl.py
+        panels = [{'data': data_zt, 'pblh_dicts': pblh, 'figname': f'bench_zt_{i}.png'} for i in range(9)]
+        fig = dplot.draw_zt_batch(panels, np.arange(-0.04, 0.041, 0.005), 'both')[0]
+        plt.close(fig)
+
+    _record(results, 'dataPlotters.draw_zt', size, 1, _timeit(draw_zt, repeats))
+    _record(results, 'dataPlotters.draw_xt', size, 1, _timeit(draw_xt, repeats))
+    _record(results, 'dataPlotters.draw_zt_batch[9]', size, 1, _timeit(draw_zt_batch, repeats))
+
+
+def _metadata():
+    """
+    Environment information stored with the results.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {'commit': commit, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'machine': platform.machine(), 'cpu_count': os.cpu_count()}
+
+
+def run_benchmarks(sizes, cores_list, repeats=3, n_profiles=10000, workdir=None, plots=True):
+    """
+    Generate a synthetic case per size and run all benchmarks.
+
+    :param sizes: List of (nx, ny, nz, nt) tuples.
+    :param cores_list: List of core counts for the parallel benchmarks.
+    :param repeats: Number of repetitions of each timing.
+    :param n_profiles: Number of profiles for the find_BL_boundary benchmarks.
+    :param workdir: Directory for the synthetic cases and figures, a temporary one by default.
+    :param plots: Whether to time the plot routines.
+    :return: Dictionary with "meta" information and a list of "results".
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        workdir = workdir or tmpdir
+        for nx, ny, nz, nt in sizes:
+            size = f'{nx}x{ny}x{nz}x{nt}'
+            case_path = os.path.join(workdir, f'synthetic_{size}')
+            if not os.path.isdir(os.path.join(case_path, 'archive')):
+                make_synthetic_case(case_path, nx, ny, nz, nt)
+            bench_diagnostics(case_path, size, cores_list, repeats, results)
+            bench_find_BL_boundary(case_path, size, n_profiles, repeats, results)
+            if plots:
+                bench_plots(nx, nz, nt, repeats, results, os.path.join(workdir, 'fig'))
+    return {'meta': _metadata(), 'results': results}
+
+
+def compare_results(old, new):
+    """
+    Print the speedup of every benchmark present in both result files.
+
+    :param old: Results dictionary or path of a JSON file from an earlier commit.
+    :param new: Results dictionary or path of a JSON file to compare against it.
+    """
+    load = lambda res: json.load(open(res)) if isinstance(res, str) else res
+    old, new = load(old), load(new)
+    key = lambda entry: (entry['name'], entry['size'], entry['cores'])
+    old_results = {key(entry): entry for entry in old['results']}
+    print(f"{old['meta'].get('commit', '')[:10]} -> {new['meta'].get('commit', '')[:10]}")
+    for entry in new['results']:
+        if key(entry) in old_results:
+            before, after = old_results[key(entry)]['min'], entry['min']
+            print(f'{entry["name"]:40s} {entry["size"]:>18s} cores={entry["cores"]:<3d} '
+                  f'{before:9.4f}s -> {after:9.4f}s  x{before / after:6.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['64x64x30x12', '128x128x50x12'],
+                        help='case sizes as NXxNYxNZxNT')
+    parser.add_argument('--cores', nargs='+', type=int, default=[1, 4], help='core counts for the parallel benchmarks')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--profiles', type=int, default=10000, help='number of profiles for find_BL_boundary')
+    parser.add_argument('--workdir', default=None, help='keep synthetic cases in this directory for reuse')
+    parser.add_argument('--no-plots', action='store_true')
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files and exit')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare_results(*args.compare)
+    else:
+        sizes = [tuple(int(n) for n in size.lower().split('x')) for size in args.sizes]
+        output = run_benchmarks(sizes, args.cores, args.repeats, args.profiles, args.workdir, not args.no_plots)
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f'results written to {args.output}')
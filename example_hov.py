@@ -1,5 +1,5 @@
 import numpy as np
-from vvmtools.analyze import DataRetriever
+from VVManalyze import VVMTools_BL
 from vvmtools.plot import DataPlotter
 import matplotlib.pyplot as plt
 
@@ -17,16 +17,17 @@ data_domain_units = {'x':'km', 'y':'km', 'z':'km', 't':'LocalTime'}
 dplot = DataPlotter(expname, figpath, data_domain, data_domain_units)
 
 
-path = '/data/chung0823/data_VVM/VVM_Data/OceanGrass_S1_traffic'
-data = DataRetriever(path)
-NO = data.get_var_parallel(var='NO',time_steps=np.arange(721),domain_range=(0,1,None,None,None,None),compute_mean=True,axis=(0))
-NO2 = data.get_var_parallel(var='NO2',time_steps=np.arange(721),domain_range=(0,1,None,None,None,None),compute_mean=True,axis=(0))
-u = data.get_var_parallel(var='u',time_steps=np.arange(721),domain_range=(0,1,None,None,None,None),compute_mean=True,axis=(0))
+# derived fields are functions of the reduced slices, defined at module level so workers can use them
+def NOx(fields):
+    return fields['NO'] + fields['NO2']
 
-NO_mean = np.mean(NO, axis=1).reshape(nt,1)
-NO2_mean = np.mean(NO2, axis=1).reshape(nt,1)
-# data_xt2d  = (NO-NO_mean) + (NO2-NO2_mean)
-data_xt2d  = u
+path = '/data/chung0823/data_VVM/VVM_Data/OceanGrass_S1_traffic'
+data = VVMTools_BL(path)
+# one pass over the time steps for all variables, each (nt, nx);
+# NOx_prime = (NO-NO_mean) + (NO2-NO2_mean) is the deviation of NO + NO2 from its x-mean
+hov = data.get_hovmoller(['NO','NO2','u'],time_steps=np.arange(721),domain_range=(0,1,None,None,None,None),axis=(0),
+                         derived={'NOx':NOx},anomaly={'NOx_prime':'NOx'},cores=5)
+data_xt2d  = hov['u']
 
 fig, ax, cax = dplot.draw_xt(data = data_xt2d,
                                 levels = np.arange(-3.,3.001,0.2),
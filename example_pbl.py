@@ -21,7 +21,7 @@ dplot = DataPlotter(expname, figpath, data_domain, data_domain_units)
 # TODO: Use your tracer data, noted that you need to normalize the data by its maximum
 # Normalize: data/data.max()
 path = '/data/chung0823/data_VVM/VVM_Data/OceanGrass_S1_traffic'
-myTool = VVMTools_BL(path)
+myTool = VVMTools_BL(path, cache_dir='./cache/')  # reruns reuse the cached diagnostics
 
 # Compute theta, TKE (Turbulent Kinetic Energy), Enstrophy, and vertical heat flux (w'theta')
 # func_config={"domain_range":(None,None,None,None,None,None)}
@@ -29,18 +29,19 @@ func_configs=[{"domain_range":(None,None,None,None,None,None)}, # Full domain
               {"domain_range":(None,None,None,None,0,64)},      # Ocean region
               {"domain_range":(None,None,None,None,64,128)}]    # Grass region
 region_lists=['domain','ocean','grass'] # Names of the regions for boundary layer analysis
+regions_config={"regions":{region:func_config["domain_range"] for region, func_config in zip(region_lists, func_configs)}}
+
+# The BL diagnostics do not depend on the tracer, so compute them once for all regions, shape (nt, region, nz)
+diags = myTool.calc_BL_diagnostics(time_steps=time,func_config=regions_config,cores=20)
 
 trs = ['tr01','tr02','tr03']
 heights = ['sfc','750m','1500m']
 for i in range(3):
-    for region, func_config in zip(region_lists, func_configs):
+    for r, (region, func_config) in enumerate(zip(region_lists, func_configs)):
         data_zt2d  = myTool.get_var_parallel(var=trs[i],time_steps=np.arange(721),domain_range=func_config['domain_range'],compute_mean=True,axis=(1,2),cores=20)
         data_zt2d /= np.max(data_zt2d)
 
-        th = myTool.get_var_parallel('th',time_steps=time,domain_range=func_config["domain_range"],compute_mean=True,axis=(1,2),cores=20)
-        TKE = myTool.func_time_parallel(func=myTool.calc_TKE,time_steps=time,func_config=func_config,cores=20)
-        Enstrophy = myTool.func_time_parallel(func=myTool.calc_Enstrophy,time_steps=time,func_config=func_config,cores=20)
-        w_th = myTool.func_time_parallel(func=myTool.calc_w_th,time_steps=time,func_config=func_config,cores=20)
+        th, TKE, Enstrophy, w_th = diags['th'][:,r], diags['TKE'][:,r], diags['Enstrophy'][:,r], diags['w_th'][:,r]
 
         # Calculate boundary layer heights based on different criteria
         h_BL_th_plus05 = myTool.find_BL_boundary(th,howToSearch='th_plus05K')
@@ -1,6 +1,6 @@
 import numpy as np
-from VVManalyze import VVMTools_BL
-from vvmtools.plot import DataPlotter
+from VVMcampaign import BLCampaign
+from plottools import dataPlotters
 import matplotlib.pyplot as plt
 
 # prepare expname and data coordinate
@@ -22,56 +22,65 @@ func_configs=[{"domain_range":(None,None,None,None,None,None)}, # Full domain
               {"domain_range":(None,None,None,None,0,64)},      # Ocean region
               {"domain_range":(None,None,None,None,64,128)}]    # Grass region
 region_lists=['domain','ocean','grass'] # Names of the regions for boundary layer analysis
+regions={region:func_config["domain_range"] for region, func_config in zip(region_lists, func_configs)}
 case_name = ['S1','S2']  # List of simulation cases corresponding names
 
-# Loop through the first two cases to analyze BL height in different regions
-for i in range(2):
-    case = case_list[i]
-    myTool = VVMTools_BL(path(case))
+# Compute theta, TKE (Turbulent Kinetic Energy), Enstrophy, and vertical heat flux (w'theta')
+# for the first two cases and all regions on one process pool, shape (nt, region, nz).
+# Each case is handed back as soon as it is done, so BL heights and figures are made
+# while the pool keeps working on the remaining cases; reruns reuse the cached diagnostics.
+# The campaign's process pool is closed when the with block exits, also on errors.
+# Set profile=True to write timings, bytes read and cache hit rates of each case to ./profile_<case>.json
+profile = False
+with BLCampaign({case_name[i]:path(case_list[i]) for i in range(2)}, regions, cores=20, tool_kwargs={'cache_dir':'./cache/', 'profile':profile}) as campaign:
+    for expname, diags in campaign.iter_cases(time):
+        myTool = campaign.tools[expname]
 
-    # Loop through each region (domain, ocean, grass)
-    for region, func_config in zip(region_lists, func_configs):
-       
-        expname = case_name[i]
-        
-        # Compute theta, TKE (Turbulent Kinetic Energy), Enstrophy, and vertical heat flux (w'theta')
-        th = myTool.get_var_parallel('th',time_steps=time,domain_range=func_config["domain_range"],compute_mean=True,axis=(1,2),cores=20)
-        TKE = myTool.func_time_parallel(func=myTool.calc_TKE,time_steps=time,func_config=func_config,cores=20)
-        Enstrophy = myTool.func_time_parallel(func=myTool.calc_Enstrophy,time_steps=time,func_config=func_config,cores=20)
-        w_th = myTool.func_time_parallel(func=myTool.calc_w_th,time_steps=time,func_config=func_config,cores=20)
-
-        # Calculate boundary layer heights based on different criteria
-        h_BL_th_plus05 = myTool.find_BL_boundary(th,howToSearch='th_plus05K')
-        h_BL_dthdz = myTool.find_BL_boundary(th,howToSearch='dthdz')
-        h_BL_TKE = myTool.find_BL_boundary(TKE,howToSearch='threshold',threshold=0.08)
-        h_BL_Enstrophy = myTool.find_BL_boundary(Enstrophy,howToSearch='threshold',threshold=1e-5)
-        h_BL_wth = myTool.find_BL_boundary(w_th,howToSearch='wth',threshold=1e-3)
+        # Keep the profiles for later analyses, reopen with VVMTools_BL.load_diagnostics('./store/'+expname)
+        myTool.save_diagnostics('./store/'+expname, diags, time, {'regions':regions})
 
         # create dataPlotter class
         figpath           = './fig/'
         data_domain       = {'x':x, 'y':y, 'z':z, 't':t}
         data_domain_units = {'x':'km', 'y':'km', 'z':'km', 't':'LocalTime'}
-        dplot = DataPlotter(expname, figpath, data_domain, data_domain_units)
+        dplot = dataPlotters(expname, figpath, data_domain, data_domain_units, profiler=myTool.profiler)
+
+        # Loop through each region (domain, ocean, grass)
+        panels = []
+        for r, region in enumerate(region_lists):
+       
+            th, TKE, Enstrophy, w_th = diags['th'][:,r], diags['TKE'][:,r], diags['Enstrophy'][:,r], diags['w_th'][:,r]
+
+            # Calculate boundary layer heights based on different criteria
+            h_BL_th_plus05 = myTool.find_BL_boundary(th,howToSearch='th_plus05K')
+            h_BL_dthdz = myTool.find_BL_boundary(th,howToSearch='dthdz')
+            h_BL_TKE = myTool.find_BL_boundary(TKE,howToSearch='threshold',threshold=0.08)
+            h_BL_Enstrophy = myTool.find_BL_boundary(Enstrophy,howToSearch='threshold',threshold=1e-5)
+            h_BL_wth = myTool.find_BL_boundary(w_th,howToSearch='wth',threshold=1e-3)
 
-        # draw z-t diagram
-        # input data dimension is (nz, nt)
-        # [output] figure, axis, colorbar axis
-        w_th = np.hstack((np.full((nt,1),np.nan), w_th))
-        fig, ax, cax = dplot.draw_zt(data = w_th.T, \
-                                    levels = np.arange(-0.04,0.041,0.005), \
-                                    extend = 'both', \
-                                    pblh_dicts={r'$\theta$ + 0.5 K': h_BL_th_plus05,\
-                                                r'max d$\theta$/dz': h_BL_dthdz,\
-                                                'TKE': h_BL_TKE,\
-                                                'Enstrophy': h_BL_Enstrophy ,\
-                                                r"top$ (\overline{w'\theta'}+)$":h_BL_wth[0] ,\
-                                                r"min$ (\overline{w'\theta'})$":h_BL_wth[1] ,\
-                                                r"top$ (\overline{w'\theta'}-)$":h_BL_wth[2] ,\
-                                                },\
-                                    title_left  = r'Vertical $\theta$ transport', \
-                                    title_right = region, \
-                                    figname     = 'BL_height_'+expname+'_'+region,\
-                            )
+            # z-t diagram of this region, input data dimension is (nz, nt)
+            w_th = np.hstack((np.full((nt,1),np.nan), w_th))
+            panels.append(dict(data = w_th.T, \
+                                        pblh_dicts={r'$\theta$ + 0.5 K': h_BL_th_plus05,\
+                                                    r'max d$\theta$/dz': h_BL_dthdz,\
+                                                    'TKE': h_BL_TKE,\
+                                                    'Enstrophy': h_BL_Enstrophy ,\
+                                                    r"top$ (\overline{w'\theta'}+)$":h_BL_wth[0] ,\
+                                                    r"min$ (\overline{w'\theta'})$":h_BL_wth[1] ,\
+                                                    r"top$ (\overline{w'\theta'}-)$":h_BL_wth[2] ,\
+                                                    },\
+                                        title_left  = r'Vertical $\theta$ transport', \
+                                        title_right = region, \
+                                        figname     = 'BL_height_'+expname+'_'+region,\
+                                ))
 
-        #plt.show()
+        # draw all regions on one figure, only the data, heights and titles change between them
+        # [output] figure, axis, colorbar axis, saved files
+        fig, ax, cax, saved = dplot.draw_zt_batch(panels, \
+                                                  levels = np.arange(-0.04,0.041,0.005), \
+                                                  extend = 'both', \
+                                                 )
+        plt.close(fig)
 
+        if profile:
+            myTool.profiler.dump(f'./profile_{expname}.json')
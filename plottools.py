@@ -1,17 +1,94 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import matplotlib as mpl
 import os, sys
 import logging
+import multiprocessing
+import warnings
+from VVMprofile import profiled
+
+# Resolution of the saved figures
+_SAVE_DPI = 200
+
+# Per-figure arguments of draw_zt/draw_xt; all other arguments of a spec define the shared layout
+_PANEL_KEYS = ('data', 'pblh_dicts', 'title_left', 'title_right', 'figname')
+
+def _init_export_worker():
+    """
+    Pool initializer: render headless with the Agg backend.
+    """
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+def _export_chunk(plotter, kind, layout, panels):
+    """
+    Render panels sharing one layout with draw_zt_batch or draw_xt_batch
+    and return the written file paths.
+    """
+    import matplotlib.pyplot as plt
+    fig, ax, cax, saved = getattr(plotter, f'draw_{kind}_batch')(panels, **layout)
+    plt.close(fig)
+    return saved
+
+# Block aggregations of the level-of-detail option of draw_xt/draw_zt
+_LOD_REDUCTIONS = ('mode', 'mean', 'max', 'min', 'absmax')
+
+def _block_reduce(data, coord, factor, axis, how, levels=None):
+    """
+    Reduce blocks of `factor` points along `axis` of `data` to one value,
+    and `coord` to the centers of the blocks. A trailing partial block is
+    reduced over the points it has. The 'mode' reduction bins the data
+    with `levels` like BoundaryNorm.
+    """
+    n = data.shape[axis]
+    n_blocks = -(-n // factor)
+    data = np.moveaxis(np.asarray(data, dtype=float), axis, -1)
+    padded = np.full(data.shape[:-1] + (n_blocks * factor,), np.nan)
+    padded[..., :n] = data
+    blocks = padded.reshape(data.shape[:-1] + (n_blocks, factor))
+
+    with warnings.catch_warnings():
+        # All-NaN blocks reduce to NaN and stay blank, like NaNs in the full data
+        warnings.simplefilter('ignore', RuntimeWarning)
+        if how == 'mode':
+            # The most frequent level bin, represented by the first value of the block in it
+            bins = np.where(np.isnan(blocks), -1, np.digitize(blocks, levels))
+            counts = np.stack([np.sum(bins == k, axis=-1) for k in range(len(levels) + 1)], axis=-1)
+            mode = np.argmax(counts, axis=-1)[..., np.newaxis]
+            index = np.argmax(bins == mode, axis=-1)[..., np.newaxis]
+            reduced = np.take_along_axis(blocks, index, axis=-1)[..., 0]
+        elif how == 'mean':
+            reduced = np.nanmean(blocks, axis=-1)
+        elif how == 'max':
+            reduced = np.nanmax(blocks, axis=-1)
+        elif how == 'min':
+            reduced = np.nanmin(blocks, axis=-1)
+        else:
+            # The value of largest magnitude, keeping its sign
+            magnitude = np.where(np.isnan(blocks), -np.inf, np.abs(blocks))
+            index = np.argmax(magnitude, axis=-1)[..., np.newaxis]
+            reduced = np.take_along_axis(blocks, index, axis=-1)[..., 0]
+
+    first = coord[0:n:factor]
+    last = coord[np.minimum(np.arange(n_blocks) * factor + factor, n) - 1]
+    return np.moveaxis(reduced, -1, axis), first + (last - first) / 2
+
+def _layout_key(kind, layout, panel):
+    """
+    Hashable description of everything panels must share to be drawn on one figure.
+    """
+    shared = tuple((name, repr(np.asarray(value).tolist())) for name, value in sorted(layout.items()))
+    return kind, shared, np.shape(panel['data']), tuple(panel.get('pblh_dicts', {}))
 
 class dataPlotters:
-    def __init__(self, exp, figpath, domain, units, ticks=None, time_fmt='%H'):
+    def __init__(self, exp, figpath, domain, units, ticks=None, time_fmt='%H', profiler=None):
         self.EXP              = exp
         self.FIGPATH          = figpath
         self.DOMAIN           = domain
         self.DOMAIN_UNITS     = units
         self.CUSTOM_TIME_FMT  = time_fmt
         self.DOMAIN_TICKS = self._default_dim_ticks(ticks)
+        # optional VVMprofile.Profiler timing the draw_* calls, e.g. VVMTools_BL(...).profiler
+        self.profiler     = profiler
 
         self._check_create_figpath()
 
@@ -28,11 +105,13 @@ class dataPlotters:
             os.system(f'mkdir -p {self.FIGPATH}')
 
     def _default_setting(self):
+        import matplotlib.pyplot as plt
         plt.rcParams.update({'font.size':17,
                              'axes.linewidth':2,
                              'lines.linewidth':2})
 
     def _create_figure(self, figsize):
+        import matplotlib.pyplot as plt
         self._default_setting()
         fig     = plt.figure(figsize=figsize)
         if figsize[0] / figsize[1] >= 1:
@@ -44,11 +123,12 @@ class dataPlotters:
         return fig, ax, cax
 
     def _get_cmap(self, cmap_name='jet'):
+        import matplotlib.pyplot as plt
         if cmap_name=='':
             # define custom colormap
             pass
         else:
-           cmap = mpl.pyplot.get_cmap(cmap_name)
+           cmap = plt.get_cmap(cmap_name)
         return cmap
 
     def _get_clear_ticks(self, ax_name, ax_lim=None):
@@ -102,6 +182,45 @@ class dataPlotters:
 
         return  lim, ticks
 
+    def _apply_lod(self, data, dims, fig, ax, lod, levels):
+        """
+        Level of detail: block-reduce the (row, column) data to at most one 
+        value per pixel of the axes in the saved figure.
+
+        :param data: 2D array with dimensions `dims`.
+        :param dims: Domain names of the rows and columns, e.g. ('z', 't').
+        :param lod: None or False to keep the data, True for 'mode', or one of 
+                    'mode' (the most frequent color level of the block), 'mean', 
+                    'max', 'min' and 'absmax' (largest magnitude, keeping the sign). 
+                    All reductions except 'mean' pick a value of the block, so the 
+                    reduced data only shows colors the full data has; 'mean' does 
+                    not keep the levels: averaging across a level boundary can 
+                    give a color that none of the points of the block has. The 
+                    extremes keep narrow features and values beyond the outer 
+                    levels visible.
+        :param levels: BoundaryNorm levels of the plot, binning the data for 'mode'.
+        :return: Row coordinates, column coordinates and the reduced data.
+        """
+        rows, cols = self.DOMAIN[dims[0]], self.DOMAIN[dims[1]]
+        if not lod:
+            return rows, cols, data
+        how = 'mode' if lod is True else lod
+        if how not in _LOD_REDUCTIONS:
+            raise ValueError(f'Unknown level of detail reduction {how!r}, choose from {_LOD_REDUCTIONS}.')
+
+        # Size of the axes in pixels of the saved figure
+        box = ax.get_position()
+        width, height = fig.get_size_inches()
+        pixels = (box.height * height * _SAVE_DPI, box.width * width * _SAVE_DPI)
+
+        coords = [rows, cols]
+        for axis in (0, 1):
+            factor = int(np.ceil(data.shape[axis] / pixels[axis]))
+            if factor > 1:
+                data, coords[axis] = _block_reduce(data, coords[axis], factor, axis, how, levels)
+        return coords[0], coords[1], data
+
+    @profiled('dataPlotters.draw_xt')
     def draw_xt(self, data, \
                       levels, \
                       extend, \
@@ -112,7 +231,9 @@ class dataPlotters:
                       xlim = None, \
                       ylim = None,\
                       figname='',\
+                      lod = None,\
                ):
+        import matplotlib.pyplot as plt
         xlim, xticks = self._determine_ticks_and_lim(ax_name=x_axis_dim, ax_lim=xlim)
         ylim, yticks = self._determine_ticks_and_lim(ax_name='t', ax_lim=ylim)
 
@@ -121,7 +242,9 @@ class dataPlotters:
         cmap = self._get_cmap(cmap_name)
         norm = mpl.colors.BoundaryNorm(boundaries=levels, \
                   ncolors=256, extend=extend)
-        PO = plt.pcolormesh(self.DOMAIN[x_axis_dim], self.DOMAIN['t'], data, \
+        # optionally block-reduce long or wide data to the pixel resolution, see _apply_lod
+        t_coord, x_coord, data = self._apply_lod(data, ('t', x_axis_dim), fig, ax, lod, levels)
+        PO = plt.pcolormesh(x_coord, t_coord, data, \
                        cmap=cmap, norm=norm, \
                       )
         plt.colorbar(PO, cax=cax)
@@ -136,9 +259,10 @@ class dataPlotters:
         plt.title(f'{title_right}\n{self.EXP}', loc='right', fontsize=15)
         plt.title(f'{title_left}', loc='left', fontsize=20, fontweight='bold')
         if len(figname)>0:
-            plt.savefig(f'{self.FIGPATH}/{figname}', dpi=200)
+            plt.savefig(f'{self.FIGPATH}/{figname}', dpi=_SAVE_DPI)
         return fig, ax, cax
 
+    @profiled('dataPlotters.draw_zt')
     def draw_zt(self, data, \
                       levels, \
                       extend, \
@@ -149,7 +273,9 @@ class dataPlotters:
                       xlim = None, \
                       ylim = None,\
                       figname='',\
+                      lod = None,\
                ):
+        import matplotlib.pyplot as plt
         xlim, xticks = self._determine_ticks_and_lim(ax_name='t', ax_lim=xlim)
         ylim, yticks = self._determine_ticks_and_lim(ax_name='z', ax_lim=ylim)
 
@@ -158,7 +284,9 @@ class dataPlotters:
         cmap = self._get_cmap(cmap_name)
         norm = mpl.colors.BoundaryNorm(boundaries=levels, \
                   ncolors=256, extend=extend)
-        PO = plt.pcolormesh(self.DOMAIN['t'], self.DOMAIN['z'], data, \
+        # optionally block-reduce long or tall data to the pixel resolution, see _apply_lod
+        z_coord, t_coord, data = self._apply_lod(data, ('z', 't'), fig, ax, lod, levels)
+        PO = plt.pcolormesh(t_coord, z_coord, data, \
                        cmap=cmap, norm=norm, \
                       )
         plt.colorbar(PO, cax=cax)
@@ -177,6 +305,156 @@ class dataPlotters:
         plt.title(f'{title_right}\n{self.EXP}', loc='right', fontsize=15)
         plt.title(f'{title_left}', loc='left', fontsize=20, fontweight='bold')
         if len(figname)>0:
-            plt.savefig(f'{self.FIGPATH}/{figname}', dpi=200)
+            plt.savefig(f'{self.FIGPATH}/{figname}', dpi=_SAVE_DPI)
         return fig, ax, cax
 
+
+    def _render_batch(self, fig, ax, panels, draw_keys, reduce=None):
+        """
+        Render every panel into the figure built for the first one, only 
+        replacing the mesh data, scatter offsets and titles before saving.
+        `reduce` applies the level of detail of the first panel to the data.
+        """
+        mesh = ax.collections[0]
+        scatters = ax.collections[1:]
+        x_offsets = [scatter.get_offsets()[:, 0].copy() for scatter in scatters]
+        shape = mesh.get_array().shape
+        saved = []
+        for panel in panels:
+            data = np.ma.masked_invalid(reduce(panel['data']) if reduce else panel['data'])
+            if data.shape != shape:
+                raise ValueError(f'All panels must have data of shape {shape}, got {data.shape}.')
+            mesh.set_array(data)
+
+            pblh_dicts = panel.get('pblh_dicts', {})
+            if list(pblh_dicts) != draw_keys:
+                raise ValueError(f'All panels must have the pblh_dicts keys {draw_keys}, got {list(pblh_dicts)}.')
+            for scatter, x, value in zip(scatters, x_offsets, pblh_dicts.values()):
+                scatter.set_offsets(np.column_stack([x, value]))
+
+            ax.set_title(f"{panel.get('title_right', '')}\n{self.EXP}", loc='right', fontsize=15)
+            ax.set_title(f"{panel.get('title_left', '')}", loc='left', fontsize=20, fontweight='bold')
+            figname = panel.get('figname', '')
+            if len(figname)>0:
+                fig.savefig(f'{self.FIGPATH}/{figname}', dpi=_SAVE_DPI)
+                saved.append(f'{self.FIGPATH}/{figname}')
+        return saved
+
+    @profiled('dataPlotters.draw_zt_batch')
+    def draw_zt_batch(self, panels, \
+                            levels, \
+                            extend, \
+                            cmap_name='bwr',\
+                            xlim = None, \
+                            ylim = None,\
+                            legend = True,\
+                            lod = None,\
+                     ):
+        """
+        Draw many z-t diagrams sharing levels, colormap, axes limits and 
+        boundary layer height labels, e.g. one per case and region.
+
+        The figure, colorbar, ticks and legend are built once for the first 
+        panel; every panel then only updates the mesh data, the scatter 
+        offsets of its boundary layer heights and the titles before saving.
+
+        :param panels: Iterable of dictionaries with the per-figure arguments of 
+                       draw_zt: 'data' (nz, nt), 'pblh_dicts', 'title_left', 
+                       'title_right' and 'figname'. All panels need data of the 
+                       same shape and pblh_dicts with the same keys in the same order.
+        :param legend: Keep the legend of the boundary layer heights.
+        :param lod: Level of detail of the mesh, see _apply_lod.
+        :return: fig, ax, cax of the shared figure and the list of saved files.
+        """
+        panels = list(panels)
+        first = panels[0]
+        fig, ax, cax = self.draw_zt(first['data'], levels, extend, pblh_dicts=first.get('pblh_dicts', {}), 
+                                    cmap_name=cmap_name, xlim=xlim, ylim=ylim, lod=lod)
+        if not legend and ax.get_legend() is not None:
+            ax.get_legend().remove()
+        reduce = lambda data: self._apply_lod(data, ('z', 't'), fig, ax, lod, levels)[2]
+        saved = self._render_batch(fig, ax, panels, list(first.get('pblh_dicts', {})), reduce)
+        return fig, ax, cax, saved
+
+    @profiled('dataPlotters.draw_xt_batch')
+    def draw_xt_batch(self, panels, \
+                            levels, \
+                            extend, \
+                            x_axis_dim = 'x',\
+                            cmap_name='bwr', \
+                            xlim = None, \
+                            ylim = None,\
+                            lod = None,\
+                     ):
+        """
+        Draw many x-t diagrams sharing levels, colormap and axes limits, 
+        building the figure once and only updating the mesh data and titles 
+        of every panel before saving, see draw_zt_batch.
+
+        :param panels: Iterable of dictionaries with 'data' (nt, nx), 'title_left', 
+                       'title_right' and 'figname'.
+        :return: fig, ax, cax of the shared figure and the list of saved files.
+        """
+        panels = list(panels)
+        fig, ax, cax = self.draw_xt(panels[0]['data'], levels, extend, x_axis_dim=x_axis_dim, 
+                                    cmap_name=cmap_name, xlim=xlim, ylim=ylim, lod=lod)
+        reduce = lambda data: self._apply_lod(data, ('t', x_axis_dim), fig, ax, lod, levels)[2]
+        saved = self._render_batch(fig, ax, panels, [], reduce)
+        return fig, ax, cax, saved
+
+    def export(self, specs, cores=4):
+        """
+        Render many figures on a process pool with the Agg backend.
+
+        Specs with the same layout (kind, levels, extend, colormap, limits, 
+        data shape and boundary layer height labels) are drawn with the batch 
+        renderers, split into one chunk per worker, so every worker builds 
+        its figure once and then only updates data and titles.
+
+        Example:
+            >>> specs = [{"kind": "zt", "data": w_th.T, "levels": levels, "extend": "both", 
+            >>>           "pblh_dicts": heights, "title_right": region, "figname": f"BL_{region}.png"}
+            >>>          for region, w_th, heights in ...]
+            >>> paths = dplot.export(specs, cores=20)
+
+        :param specs: List of dictionaries with the arguments of draw_zt ('kind': 'zt', 
+                      the default) or draw_xt ('kind': 'xt'), each including 'figname'.
+        :param cores: Number of worker processes, 1 to render in this process.
+        :return: Written file paths, in the order of `specs`.
+        """
+        groups = {}
+        for index, spec in enumerate(specs):
+            spec = dict(spec)
+            kind = spec.pop('kind', 'zt')
+            if kind not in ('zt', 'xt'):
+                raise ValueError(f"Unknown plot kind {kind!r}, choose 'zt' or 'xt'.")
+            if len(spec.get('figname', '')) == 0:
+                raise ValueError(f'Spec {index} has no figname, nothing would be written.')
+            panel = {name: spec.pop(name) for name in _PANEL_KEYS if name in spec}
+            key = _layout_key(kind, spec, panel)
+            groups.setdefault(key, (kind, spec, []))[2].append((index, panel))
+
+        # Split every layout group into at most `cores` chunks
+        tasks, order = [], []
+        for kind, layout, members in groups.values():
+            for chunk in np.array_split(np.arange(len(members)), min(len(members), cores)):
+                tasks.append((self, kind, layout, [members[i][1] for i in chunk]))
+                order.append([members[i][0] for i in chunk])
+
+        if cores == 1:
+            # Render headless like the workers, then restore the backend of this process
+            backend = mpl.get_backend()
+            _init_export_worker()
+            try:
+                results = [_export_chunk(*task) for task in tasks]
+            finally:
+                mpl.use(backend, force=True)
+        else:
+            with multiprocessing.Pool(processes=cores, initializer=_init_export_worker) as pool:
+                results = pool.starmap(_export_chunk, tasks)
+
+        paths = [None] * len(specs)
+        for indices, saved in zip(order, results):
+            for index, path in zip(indices, saved):
+                paths[index] = path
+        return paths
@@ -0,0 +1,40 @@
+import numpy as np
+from VVMkernels import Moments, bin_index
+
+def test_moments_merge_with_zero_count_state():
+    rng = np.random.default_rng(0)
+    a = rng.standard_normal((2, 8, 8))
+    b = rng.standard_normal((2, 8, 8))
+    # The second level of b has no valid points, e.g. under terrain or an empty region
+    b[1] = np.nan
+
+    merged = Moments.from_field(a).merge(Moments.from_field(b))
+    expected = Moments.from_field(np.concatenate([a, b], axis=-1))
+
+    np.testing.assert_array_equal(merged.n, [128, 64])
+    np.testing.assert_allclose(merged.mean, expected.mean, rtol=1e-12)
+    np.testing.assert_allclose(merged.m2, expected.m2, rtol=1e-12)
+    np.testing.assert_allclose(merged.m4, expected.m4, rtol=1e-12)
+
+
+def test_moments_combine_matches_single_pass():
+    rng = np.random.default_rng(1)
+    field = rng.gamma(2., size=(4, 3, 16, 16))
+    combined = Moments.from_array(np.stack([Moments.from_field(f).to_array() for f in field], axis=1)).combine(axis=0)
+    expected = Moments.from_field(np.concatenate(list(field), axis=-1))
+
+    for name in Moments.FIELDS:
+        np.testing.assert_allclose(getattr(combined, name), getattr(expected, name), rtol=1e-10)
+
+
+def test_bin_index_matches_histogram_at_the_edges():
+    rng = np.random.default_rng(2)
+    for _ in range(500):
+        lo = rng.uniform(-10, 10)
+        edges = np.linspace(lo, lo + rng.uniform(0.01, 20), rng.integers(2, 50))
+        # Values on and next to every edge, where rounding decides the bin
+        values = np.concatenate([edges, np.nextafter(edges, -np.inf), np.nextafter(edges, np.inf),
+                                 rng.uniform(edges[0] - 1, edges[-1] + 1, 100), [np.nan]])
+        index = bin_index(values, edges)
+        np.testing.assert_array_equal(np.bincount(index[index >= 0], minlength=len(edges) - 1),
+                                      np.histogram(values[~np.isnan(values)], edges)[0])